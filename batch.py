@@ -0,0 +1,220 @@
+# coding: utf8
+#################################### IMPORTS ###################################
+
+# Std Libs
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+
+# Package helper libs
+from .sublimeshim import install_sublime_shim
+
+# Before anything importing `sublime`
+install_sublime_shim()
+
+from . import nodeselect  # noqa: E402
+from .headless import HeadlessView  # noqa: E402
+from .nodeindex import plan_css_query  # noqa: E402
+from .scopedtokenizer import crude_tokenizer, scoped_tokenizer  # noqa: E402
+
+################################### CONSTANTS ##################################
+
+# Files are handed to workers in chunks, about this many per worker
+CHUNKS_PER_WORKER = 4
+
+# Per process: [(selector, xpath, compiled XPath, node index chain), ...] and
+# whether to select full nodes, set by `init_worker`
+SELECTORS = ()
+FULL = False
+
+################################### PIPELINE ###################################
+
+
+def build_proxy(view):
+    """
+    A NodeProxy for `view`, built the way ProxyBuilder does in the editor, or
+    None if lxml choked on it
+    """
+
+    text = view.text
+    node_proxy = nodeselect.NodeProxy(view, text[:500], xml=False)
+    feed = node_proxy.create_feed_routine().send
+    feed(None)
+
+    for token in scoped_tokenizer(view, crude_tokenizer(text), text):
+        if isinstance(feed(token), nodeselect.ET.XMLSyntaxError):
+            return None
+
+    while True:
+        try:
+            if feed(True) is False:
+                return None
+        except StopIteration:
+            break
+
+    return node_proxy if node_proxy.root is not None else None
+
+
+def compile_selector(selector, lang="css"):
+    "(xpath, compiled XPath, chain), `chain` if the node index can answer it"
+
+    if lang == "css":
+        xpath = nodeselect.css_to_xpath(selector)
+        chain = plan_css_query(selector)
+    else:
+        xpath, chain = selector, None
+
+    return xpath, nodeselect.compiled_xpath(xpath), chain
+
+
+def extract(path):
+    "Returns (path, JSON lines, error) for one file, against `SELECTORS`"
+
+    try:
+        view = HeadlessView.from_file(path)
+        node_proxy = build_proxy(view)
+        if node_proxy is None:
+            return path, [], "couldn't parse"
+
+        contexts = [node_proxy.tags_lookup[node_proxy.root]]
+        lines = []
+
+        for selector, xpath, compiled, chain in SELECTORS:
+            if chain:
+                xselect = nodeselect.IndexedSelector(chain, xpath, node_proxy)
+            else:
+                xselect = compiled
+
+            regions = nodeselect.query_regions(
+                view, node_proxy, xselect, contexts, full=FULL
+            )
+            for r in regions:
+                lines.append(
+                    json.dumps(
+                        {
+                            "file": path,
+                            "selector": selector,
+                            "begin": r.begin(),
+                            "end": r.end(),
+                        }
+                    )
+                )
+
+        return path, lines, None
+
+    except Exception as e:
+        return path, [], repr(e)
+
+
+#################################### WORKERS ###################################
+
+
+def init_worker(selectors, full=False):
+    "Compiles `selectors`, [(selector, lang), ...], once per process"
+
+    global SELECTORS, FULL
+
+    # Keep stdout clean for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        nodeselect.load_libs()
+
+    SELECTORS = tuple((s,) + compile_selector(s, lang) for (s, lang) in selectors)
+    FULL = full
+
+
+def run_batch(paths, selectors, full=False, jobs=None, out=sys.stdout):
+    """
+
+    Runs `selectors`, [(selector, "css" | "xpath"), ...], over the files at
+    `paths` on a pool of `jobs` processes (default, one per core), writing a
+    JSON line per match to `out` as each file finishes:
+
+        {"file": ..., "selector": ..., "begin": ..., "end": ...}
+
+    Files that fail are reported on stderr. Returns how many did.
+
+    """
+    jobs = jobs or os.cpu_count() or 1
+    errors = 0
+
+    with contextlib.ExitStack() as stack:
+        if jobs == 1:
+            init_worker(selectors, full)
+            results = map(extract, paths)
+        else:
+            pool = stack.enter_context(
+                multiprocessing.Pool(jobs, init_worker, (selectors, full))
+            )
+            chunksize = max(1, len(paths) // (jobs * CHUNKS_PER_WORKER))
+            results = pool.imap_unordered(extract, paths, chunksize)
+
+        for path, lines, error in results:
+            if error is not None:
+                errors += 1
+                sys.stderr.write("NodeSelect: %s: %s\n" % (path, error))
+
+            if lines:
+                out.write("\n".join(lines) + "\n")
+                out.flush()
+
+    return errors
+
+
+################################# COMMAND LINE #################################
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m %s.batch" % nodeselect.KEY,
+        description="Prints the regions NodeSelect would select for each "
+        "selector, in each file, as JSON lines",
+    )
+    parser.add_argument(
+        "-c",
+        "--css",
+        dest="selectors",
+        action="append",
+        type=lambda s: (s, "css"),
+        help="a CSS selector, may be repeated",
+    )
+    parser.add_argument(
+        "-x",
+        "--xpath",
+        dest="selectors",
+        action="append",
+        type=lambda s: (s, "xpath"),
+        help="an XPath selector, may be repeated",
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="select full nodes, not just names"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="worker processes, default one per core"
+    )
+    parser.add_argument("files", nargs="*", help="files, or - to read from stdin")
+
+    args = parser.parse_args(argv)
+    if not args.selectors:
+        parser.error("no selectors given")
+
+    paths = args.files
+    if not paths or paths == ["-"]:
+        paths = [line.strip() for line in sys.stdin if line.strip()]
+
+    # Catch bad selectors before spinning up any workers
+    with contextlib.redirect_stdout(sys.stderr):
+        nodeselect.load_libs()
+    for selector, lang in args.selectors:
+        try:
+            compile_selector(selector, lang)
+        except Exception as e:
+            parser.error("bad %s selector %r: %s" % (lang, selector, e))
+
+    return 1 if run_batch(paths, args.selectors, args.full, args.jobs) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
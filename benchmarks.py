@@ -0,0 +1,200 @@
+# coding: utf8
+#################################### IMPORTS ###################################
+
+# Std Libs
+import argparse
+import sys
+import time
+
+from collections import OrderedDict
+
+# Package helper libs
+from .sublimeshim import install_sublime_shim
+
+# Before anything importing `sublime`
+install_sublime_shim()
+
+from .batch import build_proxy  # noqa: E402
+from .headless import HeadlessView  # noqa: E402
+from .memstats import TracedPeak  # noqa: E402
+from .nodeselect import KEY, load_libs  # noqa: E402
+from .scopedtokenizer import TAG, crude_tokenizer, scoped_tokenizer  # noqa: E402
+
+################################### CONSTANTS ##################################
+
+# Buffer sizes, in characters, each input is generated at
+SIZES = (25000, 50000, 100000, 200000)
+
+# A row of well formed markup, for the pages being edited
+ROW = "<tr><td class='a'>cell {0}</td><td id='i{0}'>x <b>y</b> z</td></tr>\n"
+
+#################################### INPUTS ####################################
+
+
+def repeated(chunk, size):
+    return chunk * max(1, size // len(chunk))
+
+
+def page(size):
+    rows = []
+    length = 0
+
+    while length < size:
+        rows.append(ROW.format(len(rows)))
+        length += len(rows[-1])
+
+    return "<html><body><table>\n%s</table></body></html>" % "".join(rows)
+
+
+def typed_into(opener, size, at=0.5):
+    "A page with `opener` typed at `at` (a fraction) of the way through"
+
+    text = page(size)
+    pt = text.index("<tr>", int(len(text) * at))
+    return text[:pt] + opener + text[pt:]
+
+
+# name -> size -> text. Each leaves openers for lazy regex alternatives to scan
+# the rest of the buffer from
+ADVERSARIAL = OrderedDict(
+    [
+        ("unclosed pis", lambda size: repeated("<?a ", size)),
+        ("pis closed by >", lambda size: repeated("<?php $a->b; ", size)),
+        ("unclosed comments", lambda size: repeated("<!-- x ", size)),
+        ("stray <", lambda size: page(size // 2) + repeated("a < b ", size // 2)),
+        ("typing <!-- mid page", lambda size: typed_into("<!--", size)),
+        ("typing <? mid page", lambda size: typed_into("<?", size)),
+        ("typing < at the end", lambda size: page(size) + "<"),
+    ]
+)
+
+################################### MEASURING ##################################
+
+
+def regex_tokenize(text):
+    "How tokens were split before `crude_tokenizer` was hand written"
+
+    return sum(1 for _ in TAG.finditer(text))
+
+
+def measure(text, baseline=False, memory=False):
+    """
+
+    Seconds to tokenize `text`, and to rebuild a NodeProxy from it as
+    ProxyBuilder would, plus the rebuild's peak allocation if `memory` and
+    the old regex tokenizer's seconds if `baseline`.
+
+    """
+    view = HeadlessView(text)
+    result = OrderedDict()
+
+    started = time.perf_counter()
+    result["tokens"] = sum(1 for _ in scoped_tokenizer(view, crude_tokenizer(text)))
+    result["tokenize"] = time.perf_counter() - started
+
+    tracer = TracedPeak() if memory else None
+    if tracer is not None:
+        tracer.start()
+
+    started = time.perf_counter()
+    try:
+        build_proxy(view)
+    finally:
+        result["rebuild"] = time.perf_counter() - started
+        if tracer is not None:
+            result["peak"] = tracer.stop()
+
+    if baseline:
+        started = time.perf_counter()
+        regex_tokenize(text)
+        result["regex"] = time.perf_counter() - started
+
+    return result
+
+
+def scaling(sizes, seconds):
+    """
+    How much faster than the input the time grew from the smallest size to the
+    largest: ~1 is linear, ~`sizes` ratio is quadratic
+    """
+
+    if seconds[0] <= 0:
+        return float("nan")
+    return (seconds[-1] / seconds[0]) / (sizes[-1] / sizes[0])
+
+
+def run_benchmarks(names=None, sizes=SIZES, baseline=False, memory=False, out=None):
+    out = out or sys.stdout
+    load_libs()
+
+    for name, make in ADVERSARIAL.items():
+        if names and name not in names:
+            continue
+
+        out.write("%s\n" % name)
+        results = []
+
+        for size in sizes:
+            text = make(size)
+            result = measure(text, baseline, memory)
+            results.append((len(text), result))
+
+            line = "  %8d chars %7d tokens  tokenize %8.1fms  rebuild %8.1fms" % (
+                len(text),
+                result["tokens"],
+                result["tokenize"] * 1000,
+                result["rebuild"] * 1000,
+            )
+            if memory:
+                line += "  peak %10s bytes" % format(result["peak"], ",")
+            if baseline:
+                line += "  regex %8.1fms" % (result["regex"] * 1000)
+            out.write(line + "\n")
+
+        if len(results) > 1:
+            lengths = [length for (length, _) in results]
+            for key in ("tokenize", "rebuild", "regex"):
+                if key in results[0][1]:
+                    seconds = [result[key] for (_, result) in results]
+                    out.write("  %s scaling %.2f\n" % (key, scaling(lengths, seconds)))
+
+        out.flush()
+
+
+################################# COMMAND LINE #################################
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m %s.benchmarks" % KEY,
+        description="Times tokenizing and rebuilding buffers left mid edit, "
+        "with openers that never close",
+    )
+    parser.add_argument(
+        "names", nargs="*", help="inputs to run, default all: %s" % list(ADVERSARIAL)
+    )
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: tuple(int(n) for n in s.split(",")),
+        default=SIZES,
+        help="comma separated buffer sizes, in characters",
+    )
+    parser.add_argument(
+        "--baseline",
+        action="store_true",
+        help="also time the old regex tokenizer (quadratic on these inputs)",
+    )
+    parser.add_argument(
+        "--memory", action="store_true", help="record each rebuild's peak allocation"
+    )
+
+    args = parser.parse_args(argv)
+    unknown = set(args.names) - set(ADVERSARIAL)
+    if unknown:
+        parser.error("unknown inputs: %s" % ", ".join(sorted(unknown)))
+
+    run_benchmarks(args.names, args.sizes, args.baseline, args.memory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# coding: utf8
+#################################### IMPORTS ###################################
+
+# Std Libs
+import bisect
+import re
+import threading
+import time
+
+from collections import namedtuple
+from itertools import count
+
+# Sublime Libs
+import sublime
+
+################################### CONSTANTS ##################################
+
+# Where the syntax would put `punctuation.definition.tag.begin`, `<?` opens
+# embedded code (`punctuation.section.embedded`) in template syntaxes
+TAG_BEGIN = re.compile(r"<[/!]?[A-Za-z]")
+# Opening tags with their quoted attribute values, for `string` scopes
+TAG_WITH_STRINGS = re.compile(r"""<[A-Za-z][^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>""")
+QUOTED = re.compile(r""""[^"]*"|'[^']*'""")
+ELEMENT_NAME = re.compile(r"[\w:.-]+")
+
+LITERAL = getattr(sublime, "LITERAL", 1)
+IGNORECASE = getattr(sublime, "IGNORECASE", 2)
+
+# Keep clear of real view / buffer ids
+HEADLESS_IDS = count(-1, -1)
+
+# Approximated scopes for the buffer at `change_count`
+ScopeTable = namedtuple(
+    "ScopeTable", "change_count tag_begins string_begins string_ends"
+)
+
+################################################################################
+
+
+class HeadlessSelection(list):
+    def add(self, region):
+        self.append(region)
+
+    def add_all(self, regions):
+        self.extend(regions)
+
+    def clear(self):
+        del self[:]
+
+
+class HeadlessView:
+    """
+
+    Enough of `sublime.View` to drive NodeProxy building, ShowXPath and the
+    selection helpers without a window: a text buffer with a change count, and
+    scopes approximated from the markup (tag punctuation and attribute strings)
+    rather than a syntax definition.
+
+    Every `add_regions` / `erase_regions` is logged with a timestamp in
+    `region_log`, so callers can tell when highlights land.
+
+    """
+
+    def __init__(self, text="", scope="text.html.basic", path=None):
+        self.view_id = next(HEADLESS_IDS)
+        # (text, change count), swapped as one so readers on other threads
+        # never see one without the other
+        self.buffer = (text, 0)
+        self.scope = scope
+        self.path = path
+        self.selection = HeadlessSelection()
+        self.regions = {}
+        self.region_log = []
+        self.status = {}
+
+        self.scopes = ScopeTable(None, set(), [], [])
+        self.scopes_lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path, encoding="utf8", scope="text.html.basic"):
+        """
+        A view of the file at `path`. Line endings are normalized to newlines, as
+        Sublime does, so offsets agree with the editor's
+        """
+        with open(path, encoding=encoding, errors="replace") as fh:
+            return cls(fh.read(), scope=scope, path=path)
+
+    @property
+    def text(self):
+        return self.buffer[0]
+
+    @property
+    def changes(self):
+        return self.buffer[1]
+
+    def file_name(self):
+        return self.path
+
+    def buffer_id(self):
+        return self.view_id
+
+    def is_valid(self):
+        return True
+
+    def window(self):
+        return None
+
+    def size(self):
+        return len(self.text)
+
+    def change_count(self):
+        return self.changes
+
+    def substr(self, x):
+        if isinstance(x, int):
+            return self.text[x : x + 1]
+        return self.text[x.begin() : x.end()]
+
+    def replace(self, begin, end, text):
+        "Edits the buffer, the way a keystroke would"
+
+        old, changes = self.buffer
+        self.buffer = (old[:begin] + text + old[end:], changes + 1)
+
+    def sel(self):
+        return self.selection
+
+    def show(self, *args, **kw):
+        pass
+
+    ############################### SCOPES ###############################
+
+    def scope_table(self):
+        "The ScopeTable for the current buffer, built from a snapshot of it"
+
+        text, changes = self.buffer
+        scopes = self.scopes
+        if scopes.change_count == changes:
+            return scopes
+
+        tag_begins = set(m.start() for m in TAG_BEGIN.finditer(text))
+        string_begins, string_ends = [], []
+        for tag in TAG_WITH_STRINGS.finditer(text):
+            for q in QUOTED.finditer(tag.group()):
+                string_begins.append(tag.start() + q.start())
+                string_ends.append(tag.start() + q.end())
+
+        scopes = ScopeTable(changes, tag_begins, string_begins, string_ends)
+        with self.scopes_lock:
+            # Never swap an older buffer's table over a newer one
+            if self.scopes.change_count is None or self.scopes.change_count < changes:
+                self.scopes = scopes
+
+        return scopes
+
+    def in_string(self, pt, scopes=None):
+        scopes = scopes or self.scope_table()
+        i = bisect.bisect(scopes.string_begins, pt) - 1
+        return i >= 0 and pt < scopes.string_ends[i]
+
+    def scope_names(self, pt):
+        names = [self.scope]
+        scopes = self.scope_table()
+
+        if pt in scopes.tag_begins:
+            names.append("punctuation.definition.tag.begin.html")
+        if self.in_string(pt, scopes):
+            names.append("string.quoted.html")
+
+        return names
+
+    def match_selector(self, pt, selector):
+        names = self.scope_names(pt)
+
+        return any(
+            n == s or n.startswith(s + ".")
+            for s in (s.strip() for s in selector.split(","))
+            for n in names
+        )
+
+    def find_by_selector(self, selector):
+        if not any(s.strip() == "string" for s in selector.split(",")):
+            return []
+
+        table = self.scope_table()
+        return [
+            sublime.Region(a, b)
+            for (a, b) in zip(table.string_begins, table.string_ends)
+        ]
+
+    def extract_scope(self, pt):
+        m = ELEMENT_NAME.match(self.text, pt)
+        return sublime.Region(pt, m.end() if m else pt)
+
+    def find(self, pattern, start_pt, flags=0):
+        if flags & LITERAL:
+            pattern = re.escape(pattern)
+
+        m = re.compile(pattern, re.I if flags & IGNORECASE else 0).search(
+            self.text, start_pt
+        )
+        return sublime.Region(*m.span()) if m else sublime.Region(-1, -1)
+
+    ############################### REGIONS ##############################
+
+    def add_regions(self, key, regions, *args, **kw):
+        self.regions[key] = list(regions)
+        self.region_log.append((time.time(), key))
+
+    def erase_regions(self, key):
+        self.regions.pop(key, None)
+        self.region_log.append((time.time(), key))
+
+    def get_regions(self, key):
+        return self.regions.get(key, [])
+
+    def set_status(self, key, value):
+        self.status[key] = value
+
+    def erase_status(self, key):
+        self.status.pop(key, None)
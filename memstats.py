@@ -0,0 +1,228 @@
+# coding: utf8
+#################################### IMPORTS ###################################
+
+# Std Libs
+import sys
+import threading
+import tracemalloc
+
+from collections import OrderedDict
+from itertools import chain
+
+################################### CONSTANTS ##################################
+
+# Rough cost of a libxml2 node (xmlNode / xmlAttr) plus malloc overhead, lxml
+# doesn't expose the C side so the tree is estimated from its shape
+LIBXML2_NODE_BYTES = 136
+LIBXML2_ATTR_BYTES = 112
+
+################################### HELPERS ####################################
+
+
+def sizeof(obj):
+    "Shallow size, plus the instance dict if there is one"
+
+    size = sys.getsizeof(obj)
+    d = getattr(obj, "__dict__", None)
+    if d is not None:
+        size += sys.getsizeof(d)
+    return size
+
+
+def container_sizeof(container, items=()):
+    return sys.getsizeof(container) + sum(sizeof(i) for i in items)
+
+
+def tree_estimate(root):
+    "(bytes, nodes) estimate of the libxml2 side of an lxml tree"
+
+    size = nodes = 0
+
+    for e in root.iter():
+        nodes += 1
+        size += LIBXML2_NODE_BYTES
+        size += len(e.text or "") + len(e.tail or "")
+
+        for k, v in e.items():
+            size += LIBXML2_ATTR_BYTES + len(k) + len(v)
+
+    return size, nodes
+
+
+def regions_sizeof(regions):
+    "`NodeProxy.regions` with each Region's `starts` / `ends`"
+
+    size = sys.getsizeof(regions)
+    seen = set()
+
+    for node in regions.values():
+        for r in (node, node.starts, node.ends):
+            if id(r) not in seen:
+                seen.add(id(r))
+                size += sizeof(r)
+
+    return size
+
+
+def index_sizeof(index):
+    arrays = (
+        index.parents,
+        index.subtree_end,
+        index.first_child,
+        index.last_child,
+        index.next_sibling,
+        index.prev_sibling,
+    )
+    lists = chain(
+        [index.elements],
+        index.tags.values(),
+        index.ids.values(),
+        index.classes.values(),
+    )
+
+    size = sum(sys.getsizeof(a) for a in arrays)
+    for l in lists:
+        size += sys.getsizeof(l)
+    for d in (index.tags, index.ids, index.classes):
+        size += container_sizeof(d, d.keys())
+
+    return size
+
+
+def caches_sizeof(node_proxy):
+    size = 0
+
+    for cache in (node_proxy.query_cache, node_proxy.context_cache):
+        size += sys.getsizeof(cache)
+        for v in cache.values():
+            size += sys.getsizeof(v)
+            if isinstance(v, list):
+                size += sum(sizeof(r) for r in v)
+
+    return size
+
+
+################################ MEMORY REPORT #################################
+
+
+def proxy_memory(node_proxy):
+    """
+
+    Per component (bytes, count) breakdown of a NodeProxy. Python side sizes
+    are from sys.getsizeof, the lxml tree is an estimate (`tree_estimate`).
+
+    """
+    report = OrderedDict()
+    lookup = node_proxy.tags_lookup
+    elements = [k for k in lookup if not isinstance(k, int)]
+
+    if node_proxy.root is not None:
+        report["lxml tree (est.)"] = tree_estimate(node_proxy.root)
+    report["element proxies"] = (
+        sum(sys.getsizeof(e) for e in elements),
+        len(elements),
+    )
+    report["tags_lookup"] = (sys.getsizeof(lookup), len(lookup))
+    report["regions"] = (regions_sizeof(node_proxy.regions), len(node_proxy.regions))
+    report["positions"] = (
+        container_sizeof(node_proxy.positions, node_proxy.positions),
+        len(node_proxy.positions),
+    )
+    if node_proxy.index is not None:
+        report["index"] = (
+            index_sizeof(node_proxy.index),
+            len(node_proxy.index.parents),
+        )
+    columns = node_proxy.columns
+    if columns is not None:
+        arrays = columns.full + columns.names + columns.strings
+        report["region columns"] = (
+            sum(sys.getsizeof(a) for a in arrays + (node_proxy.name_lengths,)),
+            columns.size,
+        )
+    table = node_proxy.token_table
+    if table is not None:
+        report["token table"] = (
+            container_sizeof(table.tokens, chain(table.tokens, *table.tokens))
+            + container_sizeof(table.starts, table.starts),
+            len(table.tokens),
+        )
+    report["caches"] = (
+        caches_sizeof(node_proxy),
+        len(node_proxy.query_cache) + len(node_proxy.context_cache),
+    )
+
+    return report
+
+
+def dict_memory(d):
+    "(bytes, count) for the ViewData style dicts of bunches"
+
+    size = sys.getsizeof(d)
+    for v in d.values():
+        size += sys.getsizeof(v)
+        for k in getattr(v, "values", lambda: ())():
+            size += sys.getsizeof(k)
+    return size, len(d)
+
+
+def format_report(report):
+    lines = []
+    total = 0
+
+    for component, (size, count) in report.items():
+        total += size
+        lines.append("  %-20s %12s bytes  %8s" % (component, format(size, ","), count))
+
+    lines.append("  %-20s %12s bytes" % ("total", format(total, ",")))
+    return "\n".join(lines)
+
+
+################################### TRACING ####################################
+
+
+class TracedPeak:
+    """
+
+    Records the peak tracemalloc allocation between `start` and `stop`.
+
+    Tracing is process wide: it's started by the first tracer and stopped by
+    the last, so concurrent rebuilds see each other's allocations.
+
+    """
+
+    lock = threading.Lock()
+    active = 0
+    # Whether we started tracing, rather than someone else in the host
+    owned = False
+
+    def __init__(self):
+        self.peak = None
+        self.running = False
+
+    def start(self):
+        with TracedPeak.lock:
+            if not TracedPeak.active:
+                TracedPeak.owned = not tracemalloc.is_tracing()
+                if TracedPeak.owned:
+                    tracemalloc.start()
+                elif hasattr(tracemalloc, "reset_peak"):
+                    tracemalloc.reset_peak()
+            TracedPeak.active += 1
+
+        self.running = True
+        self.baseline = tracemalloc.get_traced_memory()[0]
+
+    def stop(self):
+        if not self.running:
+            return self.peak
+
+        self.running = False
+        self.peak = max(0, tracemalloc.get_traced_memory()[1] - self.baseline)
+
+        with TracedPeak.lock:
+            TracedPeak.active -= 1
+            if not TracedPeak.active and TracedPeak.owned:
+                tracemalloc.stop()
+
+        return self.peak
@@ -0,0 +1,274 @@
+# coding: utf8
+#################################### IMPORTS ###################################
+
+# Std Libs
+import re
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+
+################################### CONSTANTS ##################################
+
+# What XPath's normalize-space() considers whitespace, cssselect matches class
+# tokens against that
+CLASS_TOKENS = re.compile(r"[^ \t\r\n]+").findall
+
+IDENT = r"-?[_a-zA-Z][\w-]*"
+COMPOUND = re.compile(r"(%s|\*)?((?:[#.]%s)*)$" % (IDENT, IDENT))
+COMPOUND_PART = re.compile(r"([#.])(%s)" % IDENT)
+COMBINATOR = re.compile(r"(\s*>\s*|\s+)")
+
+# Anything deeper than this goes to lxml
+MAX_CHAIN_LENGTH = 4
+# Query results remembered per index
+QUERY_CACHE_SIZE = 32
+
+################################################################################
+
+Compound = namedtuple("Compound", "tag ids classes")
+
+
+def plan_css_query(css):
+    """
+
+    Parses `tag`, `#id`, `.class`, `tag#id.class` style selectors, joined by
+    descendant or child combinators, into [(combinator, Compound), ...].
+
+    Returns None for anything else, which should be left to lxml. Chains are
+    tuples, so they can key caches.
+
+    """
+    parts = COMBINATOR.split(css.strip())
+    if not parts[0] or len(parts) > MAX_CHAIN_LENGTH * 2 - 1:
+        return None
+
+    chain = []
+    combinator = " "
+
+    for i, part in enumerate(parts):
+        if i % 2:
+            combinator = part.strip() or " "
+            continue
+
+        m = COMPOUND.match(part)
+        if not part or m is None:
+            return None
+
+        tag, rest = m.groups()
+        ids, classes = [], []
+        for kind, name in COMPOUND_PART.findall(rest):
+            (ids if kind == "#" else classes).append(name)
+
+        # cssselect's HTMLTranslator lower cases element names
+        tag = None if tag in (None, "*") else tag.lower()
+        chain.append((combinator, Compound(tag, tuple(ids), tuple(classes))))
+
+    return tuple(chain)
+
+
+def narrows(previous, chain):
+    """
+    True if `chain` only differs from `previous` by a more specific last
+    compound, ie `div` -> `div.foo`, so its matches are a subset
+    """
+
+    if len(previous) != len(chain) or previous[:-1] != chain[:-1]:
+        return False
+
+    (was_combinator, was), (combinator, now) = previous[-1], chain[-1]
+
+    return (
+        was_combinator == combinator
+        and was.tag in (None, now.tag)
+        and set(was.ids) <= set(now.ids)
+        and set(was.classes) <= set(now.classes)
+    )
+
+
+def intersect(lists):
+    "Intersection of sorted index lists, probing the larger with bisect"
+
+    lists = sorted(lists, key=len)
+    result = lists[0]
+
+    for other in lists[1:]:
+        n = len(other)
+        kept = []
+        for i in result:
+            j = bisect_left(other, i)
+            if j < n and other[j] == i:
+                kept.append(i)
+        result = kept
+
+    return result
+
+
+################################## NODE INDEX ##################################
+
+
+class NodeIndex:
+    """
+
+    Tree shape and inverted tag / id / class lists, by NodeProxy node index
+    (document order), so simple selectors and structural navigation never touch
+    lxml. The child / sibling links only run between elements, -1 is nothing.
+
+    """
+
+    def __init__(self):
+        self.parents = array("l")
+        self.subtree_end = array("l")
+        self.first_child = array("l")
+        self.last_child = array("l")
+        self.next_sibling = array("l")
+        self.prev_sibling = array("l")
+        self.elements = []
+        self.tags = defaultdict(list)
+        self.ids = defaultdict(list)
+        self.classes = defaultdict(list)
+
+        self.query_cache = {}
+        self.last_query = None
+
+    def add(self, index, parent, tag=None, id_=None, class_=None):
+        "Nodes must be added in document order, `tag` None for non elements"
+
+        self.parents.append(parent)
+        self.subtree_end.append(index)
+        for links in (
+            self.first_child,
+            self.last_child,
+            self.next_sibling,
+            self.prev_sibling,
+        ):
+            links.append(-1)
+
+        if tag is None:
+            return
+
+        if parent != -1:
+            sibling = self.last_child[parent]
+            if sibling == -1:
+                self.first_child[parent] = index
+            else:
+                self.next_sibling[sibling] = index
+                self.prev_sibling[index] = sibling
+            self.last_child[parent] = index
+
+        self.elements.append(index)
+        self.tags[tag].append(index)
+
+        if id_ is not None:
+            self.ids[id_].append(index)
+
+        if class_:
+            for token in set(CLASS_TOKENS(class_)):
+                self.classes[token].append(index)
+
+    def close(self):
+        "Works out subtree extents, children always come after their parents"
+
+        parents, subtree_end = self.parents, self.subtree_end
+
+        for i in range(len(parents) - 1, 0, -1):
+            parent = parents[i]
+            if parent != -1 and subtree_end[i] > subtree_end[parent]:
+                subtree_end[parent] = subtree_end[i]
+
+    def compound_lists(self, compound):
+        lists = []
+
+        if compound.tag is not None:
+            lists.append(self.tags.get(compound.tag, ()))
+        for id_ in compound.ids:
+            lists.append(self.ids.get(id_, ()))
+        for class_ in compound.classes:
+            lists.append(self.classes.get(class_, ()))
+
+        return lists
+
+    def compound_candidates(self, compound, lo, hi):
+        "Sorted indices in [lo, hi] matching `compound`"
+
+        lists = self.compound_lists(compound) or [self.elements]
+
+        lists = [l[bisect_left(l, lo) : bisect_right(l, hi)] for l in lists]
+        return intersect(lists)
+
+    def descendants_of(self, ancestors, candidates):
+        "Candidates with an ancestor in `ancestors`, one sweep over both"
+
+        subtree_end = self.subtree_end
+        stack = []
+        out = []
+        i, n = 0, len(ancestors)
+
+        for c in candidates:
+            while i < n and ancestors[i] < c:
+                a = ancestors[i]
+                while stack and subtree_end[stack[-1]] < a:
+                    stack.pop()
+                stack.append(a)
+                i += 1
+
+            while stack and subtree_end[stack[-1]] < c:
+                stack.pop()
+
+            if stack:
+                out.append(c)
+
+        return out
+
+    def children_of(self, parents, candidates):
+        parents = set(parents)
+        return [c for c in candidates if self.parents[c] in parents]
+
+    def query(self, chain, context=0, include_self=True):
+        """
+
+        Sorted indices matching a `plan_css_query` chain, restricted to the
+        subtree of `context` as `descendant-or-self::` (or `descendant::`)
+
+        Results are cached, and a chain that `narrows` the previous query (as
+        happens typing into the live preview) just filters its results.
+
+        """
+        key = (chain, context, include_self)
+
+        matched = self.query_cache.get(key)
+        if matched is not None:
+            return matched
+
+        last = self.last_query
+        if last is not None and last[0][1:] == key[1:] and narrows(last[0][0], chain):
+            matched = intersect([last[1]] + self.compound_lists(chain[-1][1]))
+        else:
+            matched = self.evaluate(chain, context, include_self)
+
+        if len(self.query_cache) >= QUERY_CACHE_SIZE:
+            del self.query_cache[next(iter(self.query_cache))]
+
+        self.query_cache[key] = matched
+        self.last_query = (key, matched)
+        return matched
+
+    def evaluate(self, chain, context, include_self):
+        lo = context if include_self else context + 1
+        hi = self.subtree_end[context]
+
+        matched = []
+        for n, (combinator, compound) in enumerate(chain):
+            candidates = self.compound_candidates(compound, lo, hi)
+
+            if not n:
+                matched = candidates
+            elif combinator == ">":
+                matched = self.children_of(matched, candidates)
+            else:
+                matched = self.descendants_of(matched, candidates)
+
+            if not matched:
+                break
+
+        return matched
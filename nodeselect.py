@@ -4,18 +4,19 @@
 
 # Std Libs
 import bisect
+import heapq
 import re
 import sys
 import time
 import threading
 
-from collections import defaultdict, deque
-from itertools import chain
-from functools import partial
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from itertools import chain, count, repeat
+from functools import lru_cache, partial
+from operator import add, attrgetter, itemgetter, methodcaller, mul
 
-# 3rd Party Libs
-from lxml import etree as ET, html
-from cssselect import HTMLTranslator as GenericTranslator
+# 3rd Party Libs (lxml & cssselect) are imported by `load_libs`, see LAZY LOADING
 
 # Sublime Libs
 import sublime
@@ -23,8 +24,10 @@ import sublime_plugin
 
 
 # Package helper libs
+from .memstats import TracedPeak, dict_memory, format_report, proxy_memory
+from .nodeindex import NodeIndex, plan_css_query
 from .trackers import back_track, track_regex
-from .scopedtokenizer import crude_tokenizer, scoped_tokenizer
+from .scopedtokenizer import TokenTable, crude_tokenizer, scoped_tokenizer
 
 ################################### CONSTANTS ##################################
 
@@ -42,10 +45,6 @@ AUTO_ROOT_START = -1
 # If we don't have a doctype we'll feed this
 DEFAULT_DOCTYPE = b"<!DOCTYPE html>"
 MODULE_LOAD_TIME = time.time()
-NON_TAGS = (ET._Comment, ET._ProcessingInstruction)
-HANDLE_ENTITIES = re.compile("&(\w+);").sub
-XMLNS = re.compile(r'xmlns=("|\').*?\1')
-XPATH_ATTRS = re.compile("/@([^ ]+)(?: |$)")
 
 XPATH_NAMESPACES = {
     "xi": "http://www.w3.org/2001/XInclude",
@@ -56,13 +55,81 @@ XPATH_NAMESPACES = {
 # Used for View data
 KEY = __package__
 
-# Recovery mode parsing should sort thiese, but this makes it explicit and works
-# better with NodeProxy
-SELF_CLOSING_DIDNT_EXPLICITLY_CLOSE = re.compile(
-    "<(area|base|basefont|br|col|frame|hr|img|input|isindex|link|meta|param|"
-    "embed|keygen,command)(>|.*?[^/]>)",
-    re.M | re.S,
-)
+# What Sublime scopes as a tag name, after the `<`. Namespaced names are scoped
+# in parts, so are left to `element_name_region`
+TAG_NAME = re.compile(r"[\w.-]+(?![\w.:-])")
+
+# Selections are applied in chunks of this many regions, anything past the
+# first chunk is added from timeouts so the UI stays responsive
+SELECTION_CHUNK_SIZE = 5000
+# Never select more than this many regions in one go
+MAX_SELECTIONS = 100000
+
+# How long (seconds) a command waits on an in-flight proxy build
+PROXY_WAIT_TIMEOUT = 1.0
+# How long the prewarmer gives one build before moving on to the next view
+PREWARM_BUILD_TIMEOUT = 10
+# Query results (as regions) remembered per proxy
+QUERY_CACHE_SIZE = 32
+
+# Record peak tracemalloc allocation of each rebuild in `NodeProxy.build_peak`,
+# toggled with the `node_select_profile_rebuilds` command
+PROFILE_REBUILDS = False
+
+################################# LAZY LOADING #################################
+
+# Nothing here is touched until the first html / xml view is activated or a
+# command runs, so sessions that never see markup don't pay for it at startup.
+ET = html = TRANSLATOR = None
+NON_TAGS = ()
+HANDLE_ENTITIES = XMLNS = XPATH_ATTRS = SELF_CLOSING_DIDNT_EXPLICITLY_CLOSE = None
+
+LIBS_LOCK = threading.Lock()
+LIBS_LOADED = False
+# Seconds spent in `load_libs`
+LIBS_LOAD_TIME = None
+
+
+def load_libs():
+    global ET, html, TRANSLATOR, NON_TAGS, LIBS_LOADED, LIBS_LOAD_TIME
+    global HANDLE_ENTITIES, XMLNS, XPATH_ATTRS, SELF_CLOSING_DIDNT_EXPLICITLY_CLOSE
+
+    if LIBS_LOADED:
+        return
+
+    with LIBS_LOCK:
+        if LIBS_LOADED:
+            return
+
+        t = time.time()
+
+        from lxml import etree as ET, html
+        from cssselect import HTMLTranslator as GenericTranslator
+
+        TRANSLATOR = GenericTranslator()
+        NON_TAGS = (ET._Comment, ET._ProcessingInstruction)
+
+        HANDLE_ENTITIES = re.compile(r"&(\w+);").sub
+        XMLNS = re.compile(r'xmlns=("|\').*?\1')
+        XPATH_ATTRS = re.compile("/@([^ ]+)(?: |$)")
+
+        # Recovery mode parsing should sort thiese, but this makes it explicit
+        # and works better with NodeProxy
+        SELF_CLOSING_DIDNT_EXPLICITLY_CLOSE = re.compile(
+            "<(area|base|basefont|br|col|frame|hr|img|input|isindex|link|meta|"
+            "param|embed|keygen,command)(>|.*?[^/]>)",
+            re.M | re.S,
+        )
+
+        LIBS_LOAD_TIME = time.time() - t
+        LIBS_LOADED = True
+
+    print("NodeSelect: loaded lxml & cssselect in %.3fs" % LIBS_LOAD_TIME)
+
+
+def is_markup_view(view):
+    return view.match_selector(0, "text.html, text.xml")
+
 
 ################################## EXCEPTIONS ##################################
 
@@ -100,6 +167,81 @@ def shrink_wrap_region(view, region):
     return sublime.Region(a, b)
 
 
+def merge_regions(regions):
+    """
+    Sorts `regions`, merging any that overlap and folding carets into regions
+    they touch. Adjacent non empty regions (sibling `td`s etc) are kept apart.
+    """
+
+    merged = []
+
+    for r in sorted(regions, key=lambda r: (r.begin(), r.end())):
+        last = merged and merged[-1]
+        if last and (
+            r.begin() < last.end()
+            or r.begin() == last.end()
+            and (r.empty() or last.empty())
+        ):
+            if r.end() > last.end():
+                merged[-1] = sublime.Region(last.begin(), r.end())
+        else:
+            merged.append(r)
+
+    return merged
+
+
+def apply_selections(view, regions, clear=True, show_surrounds=True):
+    """
+
+    Adds `regions` to the view selection with `add_all`, scrolling only once.
+
+    Large result sets are added `SELECTION_CHUNK_SIZE` at a time from timeouts,
+    abandoning the rest if the buffer or another selection run gets in first.
+    Returns the number of regions that will be selected.
+
+    """
+    regions = merge_regions(regions)
+    capped = len(regions) > MAX_SELECTIONS
+    if capped:
+        regions = regions[:MAX_SELECTIONS]
+
+    # Any chunks still pending from a previous run are now out of date
+    view_data = ViewData.data[view.view_id][KEY]
+    generation = view_data.selection_generation = (
+        view_data.get("selection_generation", 0) + 1
+    )
+    start_mod = view.change_count()
+
+    sel = view.sel()
+    if clear:
+        sel.clear()
+
+    sel.add_all(regions[:SELECTION_CHUNK_SIZE])
+    if regions:
+        view.show(regions[0], show_surrounds)
+
+    def add_chunk(offset):
+        if (
+            view_data.get("selection_generation") != generation
+            or view.change_count() != start_mod
+        ):
+            return
+
+        view.sel().add_all(regions[offset : offset + SELECTION_CHUNK_SIZE])
+        if offset + SELECTION_CHUNK_SIZE < len(regions):
+            timeout(partial(add_chunk, offset + SELECTION_CHUNK_SIZE))
+
+    if len(regions) > SELECTION_CHUNK_SIZE:
+        timeout(partial(add_chunk, SELECTION_CHUNK_SIZE))
+
+    if capped:
+        sublime.status_message(
+            "NodeSelect: selection capped at %s regions" % MAX_SELECTIONS
+        )
+
+    return len(regions)
+
+
 ################################## VIEW PROXY ##################################
 
 
@@ -109,10 +251,44 @@ class NodeProxy:
         self.xml = xml
 
         self.positions = []
+        # By node index, the length of an element's name in its opening tag,
+        # -1 if it's not an element or it's not a plain name
+        self.name_lengths = array("l")
+        # The token being fed
+        self.token = ""
         self.opened = defaultdict(list)
         self.regions = {}
         self.tags_lookup = {}
+        self.index = None
+        # RegionColumns, built on first use and dropped whenever offsets shift
+        self.columns = None
+        # Peak bytes allocated building this proxy, if PROFILE_REBUILDS
+        self.build_peak = None
+        # The view's change_count when the buffer was read, or when the last
+        # edit was recorded with `record_edit`
+        self.change_count = None
+        # Edits recorded before the tag spans were built, as (offset, removed,
+        # inserted text), for `create_lookup` to sort out
+        self.unclassified_edits = []
+        # Text edits since, as (offset, removed, inserted length), not yet
+        # applied to the offsets. Any edit touching markup makes the proxy stale
+        self.pending_edits = []
+        self.stale = False
+        # The tokens this proxy was fed, and every edit since as (offset,
+        # removed, inserted length), None once one was missed
+        self.token_table = None
+        self.token_edits = []
+        self.lock = threading.Lock()
+        # Extents of every tag / comment / pi fed, closed or not, in order
+        self.tag_spans = []
+        # Sorted, merged extents of every tag / comment / pi
+        self.span_begins = []
+        self.span_ends = []
         self.view = view
+        # view_id -> ((change_count, selections), selections_are_nodes)
+        self.context_cache = {}
+        # (xpath, context node indices, full) -> regions
+        self.query_cache = {}
         self.start_pos = AUTO_ROOT_START
         self.end_pos = AUTO_ROOT_START
         self.root = None
@@ -122,6 +298,9 @@ class NodeProxy:
         self.positions.append(start)
         self.opened[tag].append((start, self.end_pos))
 
+        name = self.token.startswith("<") and TAG_NAME.match(self.token, 1)
+        self.name_lengths.append(name.end() - 1 if name else -1)
+
     def end(self, tag):
         start, end = self.opened[tag].pop()
         node = sublime.Region(start, self.end_pos)
@@ -140,6 +319,7 @@ class NodeProxy:
             return
         start, end = self.start_pos, self.end_pos
         self.positions.append(start)
+        self.name_lengths.append(-1)
 
         node = sublime.Region(start, end)
         node.starts = node.ends = node
@@ -209,6 +389,9 @@ class NodeProxy:
                 break  # No more tokens to feed
             else:
                 token, self.start_pos, self.end_pos = val
+                self.token = token
+                if token[0] == "<":
+                    self.tag_spans.append((self.start_pos, self.end_pos))
 
             opening_tag = (
                 token[0] == "<"
@@ -268,12 +451,44 @@ class NodeProxy:
             if isinstance(t, ET._Entity):
                 t.getparent().remove(t)
 
+        index = NodeIndex()
+
         for i, tag in enumerate(
             t for t in self.root.iter() if not isinstance(t, ET._Entity)
         ):
             self.tags_lookup[tag] = i
             self.tags_lookup[i] = tag
 
+            parent = tag.getparent()
+            parent = -1 if parent is None else self.tags_lookup[parent]
+
+            if isinstance(tag.tag, str):
+                index.add(i, parent, tag.tag, tag.get("id"), tag.get("class"))
+            else:
+                index.add(i, parent)
+
+        index.close()
+
+        # From the tokens rather than `regions`, which has nothing for elements
+        # the target never saw closed
+        span_begins, span_ends = [], []
+        spans, self.tag_spans = self.tag_spans, []
+        for begin, end in spans:
+            if span_ends and begin < span_ends[-1]:
+                span_ends[-1] = max(end, span_ends[-1])
+            else:
+                span_begins.append(begin)
+                span_ends.append(end)
+
+        # Edits that came in while building can be told apart now
+        with self.lock:
+            self.span_begins, self.span_ends = span_begins, span_ends
+            self.index = index
+
+            edits, self.unclassified_edits = self.unclassified_edits, []
+            for at, removed, inserted in edits:
+                self.classify_edit(at, removed, inserted)
+
         # if any(self.opened.values()):
         #     print ("Opened values", self.opened.values())
 
@@ -283,6 +498,115 @@ class NodeProxy:
     def close(self):
         pass
 
+    def touches_markup(self, begin, end):
+        "Does [begin, end), or an insert at begin == end, touch a tag?"
+
+        i = bisect.bisect_right(self.span_ends, begin)
+        return i < len(self.span_begins) and self.span_begins[i] < end
+
+    def record_edit(self, at, removed, inserted):
+        """
+
+        Called for each edit to the buffer after the proxy read it. Edits
+        confined to text nodes are queued for `apply_pending_edits`, anything
+        that touches tag syntax marks the proxy stale. Edits made before the tag
+        spans exist wait for `create_lookup` to sort them.
+
+        """
+        with self.lock:
+            if self.token_edits is not None:
+                self.token_edits.append((at, removed, len(inserted)))
+
+            if self.stale:
+                return
+
+            if self.index is None:
+                # No tag spans to check against until `create_lookup`
+                self.unclassified_edits.append((at, removed, inserted))
+            else:
+                self.classify_edit(at, removed, inserted)
+
+    def classify_edit(self, at, removed, inserted):
+        "Queues an edit for shifting, or marks the proxy stale. Holds `lock`"
+
+        if self.stale:
+            return
+
+        if "<" in inserted or ">" in inserted:
+            self.stale = True
+            return
+
+        # Back to the coordinates the tag spans are in
+        begin, end = at, at + removed
+        for e_at, e_removed, e_inserted in reversed(self.pending_edits):
+            begin, end = (
+                unshift_offset(begin, e_at, e_removed, e_inserted),
+                unshift_offset(end, e_at, e_removed, e_inserted),
+            )
+
+        if self.touches_markup(begin, end):
+            self.stale = True
+        else:
+            self.pending_edits.append((at, removed, len(inserted)))
+
+    def retokenize(self, view, text, change_count):
+        """
+
+        A TokenTable for `text`, patched from this proxy's own, if `text` is the
+        buffer at `change_count` and every edit since the build was recorded.
+        Otherwise None, and the buffer needs a full tokenizer pass.
+
+        """
+        with self.lock:
+            if (
+                self.token_table is None
+                or self.token_edits is None
+                or self.change_count != change_count
+            ):
+                return None
+            edits = list(self.token_edits)
+
+        if not edits:
+            return self.token_table
+        return self.token_table.patched(view, text, edits)
+
+    def apply_pending_edits(self):
+        "Shifts all offsets by the queued edits, in one pass"
+
+        with self.lock:
+            edits = self.pending_edits
+            if not edits or self.stale:
+                return
+
+            def shift(r):
+                return sublime.Region(
+                    shift_offset(r.a, edits), shift_offset(r.b, edits, end=True)
+                )
+
+            regions = {}
+            for node in self.regions.values():
+                shifted = shift(node)
+                if node.starts is node:
+                    shifted.starts = shifted.ends = shifted
+                else:
+                    shifted.starts = shift(node.starts)
+                    shifted.ends = shift(node.ends)
+                regions[shifted.a] = shifted
+
+            self.positions = [shift_offset(p, edits) for p in self.positions]
+            self.regions = regions
+            self.span_begins = [shift_offset(p, edits) for p in self.span_begins]
+            self.span_ends = [shift_offset(p, edits, end=True) for p in self.span_ends]
+
+            self.query_cache.clear()
+            self.columns = None
+            self.pending_edits = []
+
+    def region_columns(self):
+        if self.columns is None:
+            self.columns = RegionColumns(self)
+        return self.columns
+
     def node_region(self, e):
         return self.regions[self.positions[self.tags_lookup[e]]]
 
@@ -293,6 +617,117 @@ class NodeProxy:
         return self.regions[self.positions[index]]
 
 
+def shift_offset(pt, edits, end=False):
+    """
+    Maps an offset through [(offset, removed, inserted length), ...] edits.
+    Inserting right at the end of a node (`end`) doesn't move it.
+    """
+
+    for at, removed, inserted in edits:
+        if pt > at or pt == at and not end:
+            pt = max(at, pt - removed) + inserted
+
+    return pt
+
+
+def unshift_offset(pt, at, removed, inserted):
+    "Maps an offset back through a single edit"
+
+    if pt >= at + inserted:
+        return pt - inserted + removed
+    return min(pt, at)
+
+
+################################ REGION COLUMNS ################################
+
+
+def gather(column, indices):
+    "column[i] for each of `indices`, as a tuple"
+
+    if len(indices) == 1:
+        return (column[indices[0]],)
+    return itemgetter(*indices)(column)
+
+
+class RegionColumns:
+    """
+
+    A NodeProxy's offsets by node index, as array columns, so a whole XPath
+    result list maps to regions by gathering rather than per hit branching and
+    view calls. Each selection style is a pair of (begins, ends) columns, a
+    begin of -1 marks nodes left to `xp_2_selections`.
+
+        full:    whole nodes
+        names:   element names, whole nodes for comments / pis
+        strings: text then tail, for the node a text / tail result belongs to,
+                 tail indices are offset by `size`
+
+    """
+
+    def __init__(self, node_proxy):
+        positions, regions = node_proxy.positions, node_proxy.regions
+        parents = node_proxy.index.parents
+        # Comments / pis after the root are in `positions` but not the tree,
+        # and never in XPath results
+        self.size = n = len(parents)
+        # Elements the target never saw closed have no region
+        unclosed = sublime.Region(-1, -1)
+        unclosed.starts = unclosed.ends = unclosed
+        nodes = [regions.get(p, unclosed) for p in positions[:n]]
+
+        # Node regions are never reversed, `a` is the begin and `b` the end
+        begin = array("l", positions[:n])
+        end = array("l", map(attrgetter("b"), nodes))
+        open_end = array("l", map(attrgetter("starts.b"), nodes))
+        close_begin = array("l", map(attrgetter("ends.a"), nodes))
+
+        # Where the first child node, and the following sibling node, begin
+        text_end = array("l", close_begin)
+        tail_end = array("l", [-1]) * n
+        last_child = array("l", [-1]) * n
+
+        for i, parent in enumerate(parents):
+            if parent != -1:
+                sibling = last_child[parent]
+                if sibling == -1:
+                    text_end[parent] = begin[i]
+                else:
+                    tail_end[sibling] = begin[i]
+                last_child[parent] = i
+
+        for parent, child in enumerate(last_child):
+            if child != -1:
+                tail_end[child] = close_begin[parent]
+
+        full_begin = array("l", begin)
+        name_begin, name_end = array("l", begin), array("l", end)
+        text_begin, tail_begin = array("l", open_end), array("l", end)
+
+        for i, (node, length) in enumerate(zip(nodes, node_proxy.name_lengths)):
+            if node is unclosed:
+                full_begin[i] = name_begin[i] = text_begin[i] = tail_begin[i] = -1
+                continue
+
+            if node.starts is node:
+                # Comments and pis outside the root aren't selectable
+                if parents[i] == -1:
+                    full_begin[i] = name_begin[i] = -1
+            elif length == -1 or begin[i] < 0:
+                name_begin[i] = -1
+            else:
+                name_begin[i] = begin[i] + 1
+                name_end[i] = begin[i] + 1 + length
+
+            if begin[i] < 0:
+                full_begin[i] = text_begin[i] = -1
+            if begin[i] < 0 or tail_end[i] == -1:
+                tail_begin[i] = -1
+
+        self.full = full_begin, end
+        self.names = name_begin, name_end
+        self.strings = text_begin + tail_begin, text_end + tail_end
+
+
 ################################### VIEW DATA ##################################
 
 
@@ -355,38 +790,144 @@ class ViewData(sublime_plugin.EventListener):
 #################################### HELPERS ###################################
 
 
-def selection_nodes(view, sels=None, node_proxy=None):
-    node_proxy = node_proxy or (
-        ViewData.buffer_data[view.buffer_id()][1][KEY].get("node_proxy")
-    )
+def proxy_ready(view_data):
+    "Event set whenever the buffer has no proxy build in flight"
+    return view_data.setdefault("proxy_ready", threading.Event())
+
+
+def build_finished(view_data, start_mod):
+    "Releases anyone waiting on the build that read the buffer at `start_mod`"
+
+    view_data.last_build_change_count = start_mod
+    proxy_ready(view_data).set()
+
+
+def current_proxy(view, view_data):
+    "The buffer's NodeProxy, shifted up to date, if it's still good to use"
+
+    node_proxy = view_data.get("node_proxy")
+
+    if node_proxy is not None:
+        node_proxy.apply_pending_edits()
+
+        if node_proxy.stale or node_proxy.change_count != view.change_count():
+            return None
+
+    return node_proxy
+
+
+def get_node_proxy(view, wait=False):
+    """
+    Returns the buffer's NodeProxy, triggering a build if there isn't a usable
+    one. With `wait`, blocks up to PROXY_WAIT_TIMEOUT for that build to land.
+    """
+    view_data = ViewData.buffer_data[view.buffer_id()][1][KEY]
+    node_proxy = current_proxy(view, view_data)
 
     if node_proxy is None:
         ProxyBuilder().trigger(view)
-        return [], node_proxy
 
-    node_starts = node_proxy.positions
-    nodes = []
+        if (
+            wait
+            and "select_node_thread" in view_data
+            and proxy_ready(view_data).wait(PROXY_WAIT_TIMEOUT)
+        ):
+            node_proxy = current_proxy(view, view_data)
 
-    for sel in sels or view.sel():
-        node_index = max(0, bisect.bisect(node_starts, sel.begin()) - 1)
-        node = node_proxy[node_index]
+    return node_proxy
 
-        if node is not None:
-            while not node.contains(sel):
-                parent = node_proxy.tags_lookup[node_index].getparent()
-                if parent is None:
-                    break
 
-                node_index = node_proxy.tags_lookup[parent]
-                node = node_proxy[node_index]
+def track_edits(view, edits):
+    """
+
+    Keeps the buffer's proxy in step with `edits`, [(offset, removed, inserted
+    text), ...], just made to the buffer, so it can be served while the rebuild
+    runs. The proxy being built follows them too, so it lands up to date. A
+    proxy that has missed any edits is marked stale.
+
+    """
+    data = ViewData.buffer_data.get(view.buffer_id())
+    if data is None or KEY not in data[1]:
+        return
+
+    view_data = data[1][KEY]
+    change_count = view.change_count()
+    last_seen = view_data.get("seen_change_count", change_count - 1)
+    view_data.seen_change_count = change_count
+
+    # The build is published before it's cleared, so read in the other order
+    building = view_data.get("building_proxy")
+    node_proxy = view_data.get("node_proxy")
+
+    for proxy in (building, node_proxy) if building is not node_proxy else (building,):
+        if proxy is None or change_count <= proxy.change_count:
+            # Nothing to follow, or the edits were in the text it was built from
+            continue
+
+        # Stale proxies still track edits, for their token table
+        if proxy.change_count != last_seen:
+            proxy.stale = True
+            proxy.token_edits = None
+            continue
+
+        for at, removed, inserted in edits:
+            proxy.record_edit(at, removed, inserted)
+        proxy.change_count = change_count
 
-            # if node is not None:
-            # if node_proxy.auto_root and node.begin() == AUTO_ROOT_START:
-            #     node = sublime.Region(0, 0)# view.size())
-            #     print ("SelectionNodes", node)
-            # node = None
-            # else:
-            nodes.append((node_index, node))
+
+def selection_nodes(view, sels=None, node_proxy=None, wait=False):
+    """
+
+    Returns [(node_index, node), ...], the innermost node containing each of
+    `sels` (in the same order), and the proxy.
+
+    Selections are taken in order of begin(), in one sweep over the node
+    offsets, keeping the ancestor path of the last node found on a stack. Each
+    selection only climbs (via `NodeIndex.parents`) until it meets that path.
+
+    """
+    node_proxy = node_proxy or get_node_proxy(view, wait=wait)
+
+    if node_proxy is None:
+        return [], node_proxy
+
+    sels = list(view.sel() if sels is None else sels)
+    node_starts = node_proxy.positions
+    parents = node_proxy.index.parents
+
+    nodes = [None] * len(sels)
+    stack, depths = [], {}
+    lo = 0
+
+    for k in sorted(range(len(sels)), key=lambda k: sels[k].begin()):
+        sel = sels[k]
+        lo = bisect.bisect(node_starts, sel.begin(), lo)
+
+        # Climb from the nearest preceding node until meeting the stack.
+        # Comments / pis after the root aren't in `parents`, they're top level
+        path = []
+        node_index = max(0, lo - 1)
+        while node_index != -1 and node_index not in depths:
+            path.append(node_index)
+            node_index = parents[node_index] if node_index < len(parents) else -1
+
+        depth = depths[node_index] + 1 if node_index != -1 else 0
+        for node_index in stack[depth:]:
+            del depths[node_index]
+        del stack[depth:]
+
+        for node_index in reversed(path):
+            depths[node_index] = len(stack)
+            stack.append(node_index)
+
+        # Then up the stack to the first node containing the selection
+        depth = len(stack) - 1
+        node = node_proxy[stack[depth]]
+        while not node.contains(sel) and depth:
+            depth -= 1
+            node = node_proxy[stack[depth]]
+
+        nodes[k] = (stack[depth], node)
 
     return nodes, node_proxy
 
@@ -417,7 +958,33 @@ def element_name_regions(view, node, ix=None, node_proxy=None):
 
 def css_to_xpath(s, only_descendants=False):
     prefix = "descendant::" if only_descendants else "descendant-or-self::"
-    return GenericTranslator().css_to_xpath(s, prefix=prefix)
+    return TRANSLATOR.css_to_xpath(s, prefix=prefix)
+
+
+class IndexedSelector:
+    """
+
+    Stands in for a compiled `ET.XPath` for CSS selectors simple enough for
+    `plan_css_query`, answering them from the proxy's NodeIndex.
+
+    """
+
+    def __init__(self, chain, path, node_proxy, only_descendants=False):
+        self.chain = chain
+        self.path = path
+        self.node_proxy = node_proxy
+        self.only_descendants = only_descendants
+
+    def __call__(self, context):
+        lookup = self.node_proxy.tags_lookup
+        return [lookup[i] for i in self.indices(lookup[context])]
+
+    def indices(self, context):
+        "Node indices matching, from the `context` node index"
+
+        return self.node_proxy.index.query(
+            self.chain, context, include_self=not self.only_descendants
+        )
 
 
 def xpath_attribute_regions(view, element, tag_starts, xpath, result):
@@ -492,6 +1059,124 @@ def xp_2_selections(view, node_proxy, xp, p, full=False):
             return [element_name_region(view, node_proxy.node_starts(p))]
 
 
+IS_ATTRIBUTE = attrgetter("is_attribute")
+IS_TAIL = attrgetter("is_tail")
+GET_PARENT = methodcaller("getparent")
+
+
+def map_results(view, node_proxy, xpath, results, full=False, indices=None):
+    """
+
+    `xp_2_selections` for a whole result list at once. Results are turned into
+    node indices in one go (or come as `indices`, from an IndexedSelector) and
+    their regions gathered from the proxy's RegionColumns. Attributes, mixed
+    result types and any hits the columns can't answer are mapped one by one.
+
+    """
+    columns = node_proxy.region_columns()
+
+    if indices is not None:
+        results = None
+        begins, ends = columns.full if full else columns.names
+
+    elif not isinstance(results, list):
+        return each_result(view, node_proxy, xpath, results, full)
+
+    elif not results:
+        return []
+
+    else:
+        lookup = node_proxy.tags_lookup.__getitem__
+
+        try:
+            if isinstance(results[0], str):
+                if any(map(IS_ATTRIBUTE, results)):
+                    return each_result(view, node_proxy, xpath, results, full)
+
+                # Tails gather from the second half of the `strings` columns
+                indices = list(
+                    map(
+                        add,
+                        map(lookup, map(GET_PARENT, results)),
+                        map(mul, map(IS_TAIL, results), repeat(columns.size)),
+                    )
+                )
+                begins, ends = columns.strings
+            else:
+                indices = list(map(lookup, results))
+                begins, ends = columns.full if full else columns.names
+
+        except (AttributeError, KeyError, TypeError):
+            return each_result(view, node_proxy, xpath, results, full)
+
+    if not indices:
+        return []
+
+    begins, ends = gather(begins, indices), gather(ends, indices)
+    if min(begins) >= 0:
+        return list(map(sublime.Region, begins, ends))
+
+    if results is None:
+        lookup = node_proxy.tags_lookup
+        results = [lookup[i] for i in indices]
+
+    regions = []
+    for p, begin, end in zip(results, begins, ends):
+        if begin >= 0:
+            regions.append(sublime.Region(begin, end))
+        else:
+            regions.extend(xp_2_selections(view, node_proxy, xpath, p, full) or ())
+
+    return regions
+
+
+def each_result(view, node_proxy, xpath, results, full=False):
+    regions = []
+    for p in results:
+        regions.extend(xp_2_selections(view, node_proxy, xpath, p, full=full) or ())
+    return regions
+
+
+@lru_cache(maxsize=64)
+def compiled_xpath(xpath):
+    return ET.XPath(xpath, namespaces=XPATH_NAMESPACES)
+
+
+def query_regions(view, node_proxy, xselect, contexts, full=False):
+    """
+
+    Runs `xselect` from each of the `contexts` node indices and maps the
+    results to selection regions. Results are cached on the proxy, which is
+    thrown away whenever the buffer is modified.
+
+    """
+    key = (xselect.path, tuple(contexts), full)
+    regions = node_proxy.query_cache.get(key)
+
+    if regions is None:
+        regions = []
+        for i in contexts:
+            if isinstance(xselect, IndexedSelector):
+                hits = map_results(
+                    view, node_proxy, xselect.path, None, full, xselect.indices(i)
+                )
+            else:
+                hits = map_results(
+                    view,
+                    node_proxy,
+                    xselect.path,
+                    xselect(node_proxy.tags_lookup[i]),
+                    full,
+                )
+            regions.extend(hits)
+
+        if len(node_proxy.query_cache) >= QUERY_CACHE_SIZE:
+            del node_proxy.query_cache[next(iter(node_proxy.query_cache))]
+        node_proxy.query_cache[key] = regions
+
+    return regions
+
+
 ################################## XPATH MIXIN #################################
 
 
@@ -559,6 +1244,9 @@ class ShowXPath(sublime_plugin.EventListener, ShowsXPathMixin):
         PITA.
 
         """
+        if not LIBS_LOADED:
+            return False
+
         view_data = ViewData.data[view.view_id][KEY]
 
         if view_data.get("already_on_selection_modified"):
@@ -566,13 +1254,9 @@ class ShowXPath(sublime_plugin.EventListener, ShowsXPathMixin):
         else:
             try:
                 view_data.already_on_selection_modified = True
-                node_proxy = ViewData.buffer_data[view.buffer_id()][1][KEY].get(
-                    "node_proxy"
-                )
+                node_proxy = get_node_proxy(view)
                 if node_proxy is not None:
                     self.show_xpath(view, node_proxy)
-                else:
-                    ProxyBuilder().trigger(view)
             finally:
                 view_data.already_on_selection_modified = False
 
@@ -583,20 +1267,52 @@ class ShowXPath(sublime_plugin.EventListener, ShowsXPathMixin):
 class ProxyBuilder(sublime_plugin.EventListener, ShowsXPathMixin):
     def on_query_context(self, view, key, op, operand, match_all):
         if key == "selections_are_nodes":
+            if not is_markup_view(view):
+                return False
+
+            load_libs()
             start_sels = list(view.sel())
-            node_sels, node_proxy = selection_nodes(view, start_sels)
+            node_proxy = get_node_proxy(view)
+
+            # Sublime asks this several times per keypress, once per binding.
+            # The cache lives on the proxy so it goes when the proxy does.
+            fingerprint = (view.change_count(), tuple((r.a, r.b) for r in start_sels))
+            if node_proxy is not None:
+                cached = node_proxy.context_cache.get(view.view_id)
+                if cached is not None and cached[0] == fingerprint:
+                    return cached[1]
+
+            node_sels, node_proxy = selection_nodes(view, start_sels, node_proxy)
             if node_proxy is None:
                 return False
-            return all((sr == nr for (sr, (i, nr)) in zip(start_sels, node_sels)))
+
+            are_nodes = all((sr == nr for (sr, (i, nr)) in zip(start_sels, node_sels)))
+            node_proxy.context_cache[view.view_id] = (fingerprint, are_nodes)
+            return are_nodes
+
+    def on_load_async(self, view):
+        if is_markup_view(view):
+            load_libs()
+            ProxyPrewarmer.schedule(view)
+
+    on_activated_async = on_load_async
 
     def on_modified_async(self, view):
+        if LIBS_LOADED:
+            self.trigger(view)
+
+    def trigger(self, view):
         if not view.match_selector(0, "text.html"):
             return
 
+        load_libs()
+
         # Get the view data related to NodeSelect
         view_data = ViewData.buffer_data[view.buffer_id()][1][KEY]
-        # Invalidate any node_proxy that has been built up
-        view_data.node_proxy = None
+        # Any node_proxy that has been built up is kept, `track_edits` shifts it
+        # or marks it stale, until the rebuild replaces it
+        ready = proxy_ready(view_data)
+        ready.clear()
 
         try:
             view_data.select_node_thread
@@ -605,14 +1321,23 @@ class ProxyBuilder(sublime_plugin.EventListener, ShowsXPathMixin):
                 target=self.thread_loop, args=(view, view_data)
             )
             t.start()
-
-    trigger = on_modified_async
+        else:
+            # A parked thread only wakes for modifications, so if it's already
+            # been through this buffer state no build is coming
+            if view_data.get("last_build_change_count") == view.change_count():
+                ready.set()
 
     def thread_loop(self, view, view_data):
         thread_started_at = time.time()
 
         while True:
+            tracer = TracedPeak() if PROFILE_REBUILDS else None
+
             try:
+                if tracer is not None:
+                    tracer.start()
+
+                started_at = time.time()
                 start_mod = view.change_count()
                 ev = threading.Event()
                 ViewData.add_oneoff_callback(
@@ -621,16 +1346,29 @@ class ProxyBuilder(sublime_plugin.EventListener, ShowsXPathMixin):
 
                 substr = view.substr(sublime.Region(0, view.size()))
                 node_proxy = NodeProxy(view, substr[:500], xml=False)
+                node_proxy.change_count = start_mod
+                # Follows edits from here, `track_edits` shifts it like the
+                # published one, so it's current when it lands
+                view_data.building_proxy = node_proxy
                 feeder = node_proxy.create_feed_routine()
                 feed = feeder.send
                 feed(None)
 
-                for token in scoped_tokenizer(view, crude_tokenizer(substr)):
+                previous = view_data.get("node_proxy")
+                table = previous and previous.retokenize(view, substr, start_mod)
+                if table is not None:
+                    tokens = table.tokens
+                else:
+                    tokens = scoped_tokenizer(view, crude_tokenizer(substr), substr)
+
+                fed = []
+                for token in tokens:
                     if view.change_count() > start_mod:
                         raise Bailed
                     else:
                         if isinstance(feed(token), ET.XMLSyntaxError):
                             raise Bailed
+                    fed.append(token)
 
                 # Finish up, turning any gears left in the machine
                 while True:
@@ -642,13 +1380,41 @@ class ProxyBuilder(sublime_plugin.EventListener, ShowsXPathMixin):
 
                 # Did we successfully build a tree?
                 if node_proxy.root is not None:
+                    if tracer is not None:
+                        node_proxy.build_peak = tracer.stop()
+
+                    node_proxy.token_table = table or TokenTable(fed)
                     view_data.node_proxy = node_proxy
-                    self.show_xpath(view, node_proxy, start_mod, threaded=True)
+                    build_finished(view_data, start_mod)
+
+                    # Current as of any edits it followed while building
+                    node_proxy = current_proxy(view, view_data)
+                    log_build(
+                        view_data,
+                        "built",
+                        start_mod if node_proxy is None else node_proxy.change_count,
+                        started_at,
+                    )
+                    if node_proxy is not None:
+                        self.show_xpath(
+                            view, node_proxy, node_proxy.change_count, threaded=True
+                        )
                 else:
                     view_data.node_proxy = None
+                    build_finished(view_data, start_mod)
 
             except Bailed:
                 "We just wait for the next modification"
+                log_build(view_data, "bailed", start_mod, started_at)
+
+                # Nothing is coming if the buffer choked the parser
+                if view.change_count() == start_mod:
+                    build_finished(view_data, start_mod)
+
+            finally:
+                view_data.building_proxy = None
+                if tracer is not None:
+                    tracer.stop()
 
             # Development convenience
             if thread_started_at < MODULE_LOAD_TIME:
@@ -663,17 +1429,157 @@ class ProxyBuilder(sublime_plugin.EventListener, ShowsXPathMixin):
                 break
 
 
+def log_build(view_data, outcome, start_mod, started_at):
+    "Records build timings for anyone (ie session replays) that set `build_log`"
+
+    build_log = view_data.get("build_log")
+    if build_log is not None:
+        build_log.append((outcome, start_mod, started_at, time.time()))
+
+
+class ProxyEditTracker(sublime_plugin.TextChangeListener):
+    @classmethod
+    def is_applicable(cls, buffer):
+        return True
+
+    def on_text_changed(self, changes):
+        if LIBS_LOADED:
+            track_edits(
+                self.buffer.primary_view(),
+                [(c.a.pt, c.b.pt - c.a.pt, c.str) for c in changes],
+            )
+
+
+################################## PREWARMING ##################################
+
+
+def prewarm_priority(view):
+    "Visible views first, then smaller buffers"
+
+    window = view.window()
+    visible = window is not None and any(
+        v is not None and v.view_id == view.view_id
+        for v in (window.active_view_in_group(g) for g in range(window.num_groups()))
+    )
+    return (not visible, view.size())
+
+
+class ProxyPrewarmer:
+    """
+
+    Builds proxies in the background as views are loaded or activated, so the
+    first command on a fresh buffer has something to work with. One build at a
+    time, in `prewarm_priority` order.
+
+    """
+
+    lock = threading.Lock()
+    queue = []
+    order = count()
+    worker = None
+
+    @classmethod
+    def schedule(cls, view):
+        if not view.match_selector(0, "text.html"):
+            return
+
+        view_data = ViewData.buffer_data[view.buffer_id()][1][KEY]
+        if view_data.get("node_proxy") is not None:
+            return
+
+        with cls.lock:
+            heapq.heappush(cls.queue, (prewarm_priority(view), next(cls.order), view))
+
+            if cls.worker is None:
+                cls.worker = threading.Thread(target=cls.run)
+                cls.worker.start()
+
+    @classmethod
+    def run(cls):
+        while True:
+            with cls.lock:
+                if not cls.queue:
+                    cls.worker = None
+                    return
+                view = heapq.heappop(cls.queue)[-1]
+
+            if not view.is_valid():
+                continue
+
+            view_data = ViewData.buffer_data[view.buffer_id()][1][KEY]
+            if view_data.get("node_proxy") is not None:
+                continue
+
+            ProxyBuilder().trigger(view)
+            if "select_node_thread" in view_data:
+                proxy_ready(view_data).wait(PREWARM_BUILD_TIMEOUT)
+
+
+################################ MEMORY REPORT #################################
+
+
+def memory_report():
+    "Per buffer NodeProxy breakdowns, plus the ViewData bookkeeping"
+
+    sections = []
+
+    for buffer_id, (views, data) in list(ViewData.buffer_data.items()):
+        node_proxy = data[KEY].get("node_proxy")
+        if node_proxy is None:
+            continue
+
+        title = "buffer %s (%s views, %s nodes)" % (
+            buffer_id,
+            views,
+            len(node_proxy.positions),
+        )
+        if node_proxy.build_peak is not None:
+            title += ", build peak %s bytes" % format(node_proxy.build_peak, ",")
+
+        sections.append((title, proxy_memory(node_proxy)))
+
+    view_data = OrderedDict()
+    view_data["buffer_data"] = dict_memory(ViewData.buffer_data)
+    view_data["data"] = dict_memory(ViewData.data)
+    view_data["oneoff_callbacks"] = dict_memory(ViewData.oneoff_callbacks)
+    sections.append(("ViewData", view_data))
+
+    return sections
+
+
+class NodeSelectMemoryReport(sublime_plugin.WindowCommand):
+    def run(self):
+        report = "\n\n".join(
+            "%s\n%s" % (title, format_report(rows)) for title, rows in memory_report()
+        )
+
+        panel = self.window.create_output_panel("node_select_memory")
+        panel.run_command("append", {"characters": report + "\n"})
+        self.window.run_command("show_panel", {"panel": "output.node_select_memory"})
+
+
+class NodeSelectProfileRebuilds(sublime_plugin.ApplicationCommand):
+    def run(self, enable=None):
+        global PROFILE_REBUILDS
+        PROFILE_REBUILDS = not PROFILE_REBUILDS if enable is None else enable
+        sublime.status_message(
+            "NodeSelect: rebuild profiling %s" % ("on" if PROFILE_REBUILDS else "off")
+        )
+
+    def is_checked(self, enable=None):
+        return PROFILE_REBUILDS
+
+
 ################################### COMMANDS ###################################
 
 
 class NodeSelectRegions(sublime_plugin.TextCommand):
     def run(self, edit, regions, show_surrounds=True):
-        view = self.view
-        view.sel().clear()
-        for r in regions:
-            view.sel().add(sublime.Region(*r))
-
-        view.show(view.sel(), show_surrounds)
+        apply_selections(
+            self.view,
+            [sublime.Region(*r) for r in regions],
+            show_surrounds=show_surrounds,
+        )
 
 
 class PathSelect(sublime_plugin.TextCommand):
@@ -689,6 +1595,14 @@ class PathSelect(sublime_plugin.TextCommand):
                 xp = s
 
             self.xpath = xp
+
+            # Simple selectors are answered straight from the node index
+            chain = css_select and plan_css_query(s)
+            if chain:
+                return IndexedSelector(
+                    chain, xp, self.node_proxy, only_descendants=only_descendants
+                )
+
             self.nsmap.update(XPATH_NAMESPACES)
             return ET.XPath(xp, namespaces=self.nsmap)
 
@@ -696,15 +1610,17 @@ class PathSelect(sublime_plugin.TextCommand):
             return sublime.status_message(repr(e))
 
     def run(self, edit, lang="css", search_in_selections=False):
+        load_libs()
         view = self.view
         start_sels = list(view.sel())
         sel_set = view.sel()
         css_select = lang == "css"
 
-        node_sels, node_proxy = selection_nodes(view, start_sels)
+        node_sels, node_proxy = selection_nodes(view, start_sels, wait=True)
         if node_proxy is None:
             return
 
+        self.node_proxy = node_proxy
         self.nsmap = dict((k, v) for k, v in node_proxy.root.nsmap.copy().items() if k)
 
         def set_selections(sels):
@@ -717,25 +1633,21 @@ class PathSelect(sublime_plugin.TextCommand):
 
         restore_sels = partial(set_selections, start_sels)
 
+        if not search_in_selections:
+            contexts = [node_proxy.tags_lookup[node_proxy.root]]
+        else:
+            contexts = [i for i, node in node_sels]
+
         def on_something(s):
             if s == "":
                 return restore_sels()
 
-            nodes = []
             sel_set.clear()
             xselect = self.create_xpath(s, css_select, search_in_selections)
             if xselect is None:
                 return restore_sels()
 
-            if not search_in_selections:
-                paths = xselect(node_proxy.root)
-            else:
-                paths = []
-                for i, node in node_sels:
-                    paths.extend(xselect(node_proxy.tags_lookup[i]))
-
-            for p in paths:
-                nodes.extend(xp_2_selections(view, node_proxy, xselect.path, p))
+            nodes = query_regions(view, node_proxy, xselect, contexts)
 
             ############################################################
 
@@ -770,18 +1682,17 @@ class PathSelect(sublime_plugin.TextCommand):
 def node_select_cmd(clear_sels=True):
     def wrapper(f):
         def wrapped(self, edit, **args):
+            load_libs()
             view = self.view
-            nodes, node_proxy = selection_nodes(view)
+            start_sels = list(view.sel())
+            nodes, node_proxy = selection_nodes(view, start_sels, wait=True)
 
             if node_proxy is not None and nodes:
                 nodes = reversed(nodes)
-                start_sels = list(view.sel())
-                if clear_sels:
-                    view.sel().clear()
+                regions = list(f(self, view, start_sels, nodes, node_proxy, **args))
 
-                for region in f(self, view, start_sels, nodes, node_proxy, **args):
-                    view.sel().add(region)
-                    view.show(region)
+                if regions:
+                    apply_selections(view, regions, clear=clear_sels)
 
         return wrapped
 
@@ -800,21 +1711,95 @@ class SelectNode(sublime_plugin.TextCommand):
         selection_style="opening_tags",
     ):
 
-        for i, node in nodes:
-            if xpath:
-                els = node_proxy.tags_lookup[i].xpath(xpath)
-                for e in [
-                    xp_2_selections(
-                        view, node_proxy, xpath, e, full=selection_style == "full_node"
-                    )
-                    for e in els
-                ]:
-                    yield from e
-            else:
+        if xpath:
+            yield from query_regions(
+                view,
+                node_proxy,
+                compiled_xpath(xpath),
+                [i for i, node in nodes],
+                full=selection_style == "full_node",
+            )
+        else:
+            for i, node in nodes:
                 yield node
 
-        if not len(view.sel()):
-            view.sel().add_all(start_sels)
+
+def step_nodes(view, node_proxy, nodes, links, steps=1, selection_style="full_node"):
+    """
+    Follows `links`, one of the NodeIndex parent / child / sibling arrays,
+    `steps` times from each node, staying put where the tree runs out, or for
+    comments / pis after the root, which aren't in it.
+
+    Elements the target never saw closed have no region, so can't be selected
+    whole. With the "full_node" style they're passed over, to the next node
+    along the same link.
+    """
+    positions, regions = node_proxy.positions, node_proxy.regions
+    full = selection_style == "full_node"
+
+    for i, node in nodes:
+        for _ in range(steps):
+            j = i
+            while True:
+                j = links[j] if j < len(links) else -1
+                if j == -1 or not full or positions[j] in regions:
+                    break
+
+            if j == -1 or positions[j] == AUTO_ROOT_START:
+                break
+            i = j
+
+        node = regions.get(positions[i])
+        if node is not None and (full or node.starts is node):
+            yield node
+        else:
+            yield element_name_region(view, positions[i])
+
+
+class SelectParentNode(sublime_plugin.TextCommand):
+    @node_select_cmd()
+    def run(self, view, start_sels, nodes, node_proxy, **args):
+        yield from step_nodes(view, node_proxy, nodes, node_proxy.index.parents, **args)
+
+
+class SelectAncestorNode(sublime_plugin.TextCommand):
+    @node_select_cmd()
+    def run(self, view, start_sels, nodes, node_proxy, n=1, **args):
+        yield from step_nodes(
+            view, node_proxy, nodes, node_proxy.index.parents, steps=n, **args
+        )
+
+
+class SelectNextSiblingNode(sublime_plugin.TextCommand):
+    @node_select_cmd()
+    def run(self, view, start_sels, nodes, node_proxy, **args):
+        yield from step_nodes(
+            view, node_proxy, nodes, node_proxy.index.next_sibling, **args
+        )
+
+
+class SelectPreviousSiblingNode(sublime_plugin.TextCommand):
+    @node_select_cmd()
+    def run(self, view, start_sels, nodes, node_proxy, **args):
+        yield from step_nodes(
+            view, node_proxy, nodes, node_proxy.index.prev_sibling, **args
+        )
+
+
+class SelectFirstChildNode(sublime_plugin.TextCommand):
+    @node_select_cmd()
+    def run(self, view, start_sels, nodes, node_proxy, **args):
+        yield from step_nodes(
+            view, node_proxy, nodes, node_proxy.index.first_child, **args
+        )
+
+
+class SelectLastChildNode(sublime_plugin.TextCommand):
+    @node_select_cmd()
+    def run(self, view, start_sels, nodes, node_proxy, **args):
+        yield from step_nodes(
+            view, node_proxy, nodes, node_proxy.index.last_child, **args
+        )
 
 
 class SelectElementName(sublime_plugin.TextCommand):
@@ -2,6 +2,7 @@
 #################################### IMPORTS ###################################
 
 # Std Libs
+import bisect
 import re
 
 # Sublime Libs
@@ -9,47 +10,157 @@ import sublime
 
 ################################### CONSTANTS ##################################
 
+# What `crude_tokenizer` splits out, as a regex. Only used to check tokens, its
+# lazy alternatives rescan to the end of the buffer for each unterminated opener
 TAG = re.compile(r"<\?.*?\?>|<!\s*?--.*?-->|<[^>]+>", re.M | re.S)
 PHP_SHORT_TAG = re.compile("^" + re.escape("<?=") + r"(\s*)")
+# The terminated alternatives of TAG
+PI = re.compile(r"<\?.*?\?>", re.M | re.S)
+COMMENT = re.compile(r"<!\s*?--.*?-->", re.M | re.S)
+COMMENT_OPEN = re.compile(r"<!\s*?--")
+# An opener nothing closed, once `scoped_tokenizer` escaped it
+ESCAPED_OPENER = re.compile(r"&lt;(\?|!\s*?--)?")
 
 ################################################################################
 
 
+class NextOccurrence:
+    """
+
+    `text.find(needle, pos)` for non decreasing `pos`, remembering the last
+    answer so no stretch of `text` is searched twice, however many openers are
+    looking for the same terminator.
+
+    """
+
+    def __init__(self, text, needle):
+        self.text = text
+        self.needle = needle
+        self.searched_from = len(text) + 1
+        self.found = -1
+
+    def __call__(self, pos):
+        if pos >= self.searched_from and (self.found == -1 or self.found >= pos):
+            return self.found
+
+        self.searched_from = pos
+        self.found = self.text.find(self.needle, pos)
+        return self.found
+
+
 def crude_tokenizer(
-    text,
+    text, pos=0
 ):  # TODO: this would be a better algorithm for `inversion_stream`
-    "Yields (token, start, end)"
+    """
 
-    last_end = end = 0
+    Yields (token, start, end), from `pos`: the tags, comments and pis TAG
+    would match, and the text between, in time linear in the buffer.
 
-    for match in TAG.finditer(text):
-        start, end = match.span()
+    An opener nothing further on could close (a `<`, `<?` or `<!--` with no
+    `>` after it) is yielded on its own, as the raw opener, for
+    `scoped_tokenizer` to escape.
+
+    """
+    find = text.find
+    pi_end = NextOccurrence(text, "?>")
+    comment_end = NextOccurrence(text, "-->")
+
+    last_end = pos
+    token_length = len(text)
+    # Found `>`s are never searched past again, but a failed search would
+    # be, from each `<` after it
+    no_tag_end_after = token_length
+
+    while True:
+        start = find("<", pos)
+        if start == -1:
+            break
+
+        opener, end = "<", -1
+        c = text[start + 1 : start + 2]
+
+        if c == "?":
+            opener = "<?"
+            end = pi_end(start + 2)
+            if end != -1:
+                end += 2
+        elif c == "!":
+            comment = COMMENT_OPEN.match(text, start)
+            if comment is not None:
+                opener = comment.group()
+                end = comment_end(comment.end())
+                if end != -1:
+                    end += 3
+
+        if end == -1:
+            if start < no_tag_end_after:
+                end = find(">", start + 1)
+                if end == -1:
+                    no_tag_end_after = start
+
+            # `<>` is just text
+            if end == start + 1:
+                pos = end
+                continue
+            elif end != -1:
+                end += 1
+            else:
+                end = start + len(opener)
 
         if start != last_end:
             yield text[last_end:start], last_end, start
 
         yield text[start:end], start, end
-        last_end = end
+        last_end = pos = end
 
-    token_length = len(text)
+    if last_end < token_length:
+        yield text[last_end:token_length], last_end, token_length
 
-    if end < token_length:
-        yield text[end:token_length], end, token_length
 
+class ScopeSpans:
+    """
 
-def find_with_scope(view, pattern, scope, start_pos=0, cond=True, flags=0):
+    Sorted, merged spans of a scope selector, found with a single
+    `find_by_selector` sweep over the buffer, so scope checks are a bisect
+    rather than a round trip to the view per point.
 
-    max_pos = view.size()
+    """
 
-    while start_pos < max_pos:
-        f = view.find(pattern, start_pos, flags)
+    def __init__(self, view, selector):
+        self.begins = []
+        self.ends = []
 
-        if not f or view.match_selector(f.begin(), scope) is cond:
-            break
-        else:
-            start_pos = f.end()
+        for r in view.find_by_selector(selector):
+            if self.ends and r.begin() <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], r.end())
+            else:
+                self.begins.append(r.begin())
+                self.ends.append(r.end())
 
-    return f
+    def span_at(self, pt):
+        "Index of the span containing `pt`, or -1"
+
+        i = bisect.bisect(self.begins, pt) - 1
+        if i >= 0 and pt < self.ends[i]:
+            return i
+        return -1
+
+    def __contains__(self, pt):
+        return self.span_at(pt) != -1
+
+    def find_outside(self, text, char, pt):
+        "Position of the first `char` at or after `pt` not inside a span"
+
+        while True:
+            pt = text.find(char, pt)
+            if pt == -1:
+                return pt
+
+            i = self.span_at(pt)
+            if i == -1:
+                return pt
+
+            pt = self.ends[i]
 
 
 def catch_up_to(to, tokenizer):
@@ -71,8 +182,15 @@ def handle_short_tags(token):
     return PHP_SHORT_TAG.sub(lambda m: "<?phpshort " + m.group(1), token)
 
 
-def scoped_tokenizer(view, tokenizer):
-    "Messy but it's peformant"
+def scoped_tokenizer(view, tokenizer, text=None):
+    """
+    Messy but it's peformant
+
+    `?>` inside strings is resolved against a table of string spans, built
+    once on the first such token, so template heavy buffers stay linear.
+    """
+
+    strings = None
 
     while True:
         try:
@@ -80,23 +198,166 @@ def scoped_tokenizer(view, tokenizer):
         except StopIteration:
             break
 
+        # An opener `crude_tokenizer` found nothing to close, it's just text
+        if token.startswith("<") and not token.endswith(">"):
+            yield "&lt;" + token[1:], start, end
+            continue
+
         if token.endswith("?>"):
-            if view.match_selector(end - 1, "string"):
-                f = find_with_scope(view, ">", "string", end, False)
+            if strings is None:
+                strings = ScopeSpans(view, "string")
+                if text is None:
+                    text = view.substr(sublime.Region(0, view.size()))
 
-                if f:
-                    end = f.end()
-                    t_region = sublime.Region(start, end)
+            if end - 1 in strings:
+                f = strings.find_outside(text, ">", end)
 
-                    normed_token = handle_short_tags(view.substr(t_region))
+                if f != -1:
+                    end = f + 1
+
+                    normed_token = handle_short_tags(text[start:end])
 
                     if not token.startswith("<?"):
                         normed_token = escape_php_token(normed_token)
 
-                    yield normed_token, start, f.end()
+                    yield normed_token, start, end
                     yield from catch_up_to(end, tokenizer)
 
                     continue
 
             token = handle_short_tags(token)
         yield token, start, end
+
+
+################################## TOKEN TABLE #################################
+
+
+def is_unstable(token):
+    """
+    Openers an edit further on could close: those yielded unclosed, and `<?` /
+    `<!--` that fell back to the next `>`
+    """
+
+    if token.startswith("<?"):
+        return PI.fullmatch(token) is None
+    if COMMENT_OPEN.match(token):
+        return COMMENT.fullmatch(token) is None
+    return ESCAPED_OPENER.fullmatch(token) is not None
+
+
+def is_scoped(token):
+    "Tokens `scoped_tokenizer` resolved against string scopes"
+
+    return "?>" in token or "?&gt;" in token
+
+
+def edit_window(edits):
+    """
+
+    Composes sequential edits, [(offset, removed, inserted length), ...], into
+    the one window they changed: (old begin, old end, new begin, new end).
+    Outside it the old and new text are the same, shifted after it.
+
+    """
+    old_begin = old_end = new_begin = new_end = edits[0][0]
+
+    for at, removed, inserted in edits:
+        end = at + removed
+
+        old_begin -= max(0, new_begin - at)
+        old_end += max(0, end - new_end)
+        new_begin = min(new_begin, at)
+        new_end = max(new_end, end) + inserted - removed
+
+    return old_begin, old_end, new_begin, new_end
+
+
+class TokenTable:
+    """
+
+    The scoped (token, start, end) stream a NodeProxy was fed, kept so the
+    next rebuild only re-tokenizes around the edits since, see `patched`.
+
+    `unstable` and `scoped` are the starts of the tokens whose extent depends
+    on text further on (`is_unstable`, `is_scoped`).
+
+    """
+
+    def __init__(self, tokens, unstable=None, scoped=None):
+        self.tokens = tokens
+        self.starts = [t[1] for t in tokens]
+
+        if unstable is None:
+            unstable = [s for (t, s, e) in tokens if is_unstable(t)]
+        if scoped is None:
+            scoped = [s for (t, s, e) in tokens if is_scoped(t)]
+
+        self.unstable = unstable
+        self.scoped = scoped
+
+    def patched(self, view, text, edits):
+        """
+
+        The TokenTable for `text`, the old text after `edits`, [(offset,
+        removed, inserted length), ...]. Tokens touching the edits are dropped
+        and the gap re-tokenized, until the fresh stream starts a token where
+        a kept one (shifted) does; from there on the old tokens are reused.
+
+        Returns None when that isn't safe, ie string scopes decided any token
+        extents (`?>` in template buffers), and a full pass is needed.
+
+        """
+        tokens, starts = self.tokens, self.starts
+        if not tokens or not edits or self.scoped:
+            return None
+
+        old_begin, old_end, new_begin, new_end = edit_window(edits)
+        delta = (new_end - new_begin) - (old_end - old_begin)
+
+        # The token the edits start in, or the one ending right where they do
+        i = max(0, bisect.bisect_right(starts, old_begin) - 1)
+        if i and starts[i] == old_begin:
+            i -= 1
+
+        # An unterminated opener before may now be terminated, start from it
+        if self.unstable and self.unstable[0] < starts[i]:
+            i = bisect.bisect_left(starts, self.unstable[0])
+
+        # A tag losing its `>` runs into the text before it
+        if i and TAG.fullmatch(tokens[i - 1][0]) is None:
+            i -= 1
+
+        restart = starts[i]
+        j, n = bisect.bisect_left(starts, old_end), len(tokens)
+        fresh = []
+
+        for token in scoped_tokenizer(view, crude_tokenizer(text, restart), text):
+            start = token[1]
+            while j < n and starts[j] + delta < start:
+                j += 1
+
+            # Back in step with the old stream, past any catching up after a
+            # scoped token
+            if (
+                j < n
+                and starts[j] + delta == start
+                and not (fresh and is_scoped(fresh[-1][0]))
+            ):
+                break
+
+            fresh.append(token)
+        else:
+            j = n
+
+        tail = tokens[j:]
+        if delta:
+            tail = [(t, s + delta, e + delta) for (t, s, e) in tail]
+
+        unstable = [s for (t, s, e) in fresh if is_unstable(t)]
+        if j < n:
+            k = bisect.bisect_left(self.unstable, starts[j])
+            unstable += [s + delta for s in self.unstable[k:]]
+
+        scoped = [s for (t, s, e) in fresh if is_scoped(t)]
+
+        return TokenTable(tokens[:i] + fresh + tail, unstable, scoped)
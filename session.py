@@ -0,0 +1,298 @@
+# coding: utf8
+#################################### IMPORTS ###################################
+
+# Std Libs
+import json
+import os
+import threading
+import time
+
+# Sublime Libs
+import sublime
+import sublime_plugin
+
+# Package helper libs
+from .headless import HeadlessView
+from .nodeselect import KEY, ProxyBuilder, ShowXPath, ViewData, load_libs, track_edits
+
+################################### CONSTANTS ##################################
+
+# How long a replay waits, after the last event, for the final proxy to land
+REPLAY_SETTLE_TIMEOUT = 10
+PERCENTILES = (50, 90, 99)
+
+################################## RECORDING ###################################
+
+
+class SessionRecorder(sublime_plugin.TextChangeListener):
+    """
+
+    Writes a buffer's edits and selections, timestamped relative to the start,
+    to a JSON lines file:
+
+        {"event": "start", "t": 0, "text": ..., "change_count": ...}
+        {"event": "edit", "t": ..., "offset": ..., "removed": ..., "inserted": ...}
+        {"event": "selection", "t": ..., "regions": [[a, b], ...]}
+
+    """
+
+    # buffer_id -> SessionRecorder
+    recorders = {}
+
+    @classmethod
+    def is_applicable(cls, buffer):
+        # Only ever attached by NodeSelectRecordSession
+        return False
+
+    def __init__(self, view, path):
+        super().__init__()
+        self.path = path
+        self.out = open(path, "w", encoding="utf8")
+        self.started_at = time.time()
+
+        self.write(
+            event="start",
+            text=view.substr(sublime.Region(0, view.size())),
+            change_count=view.change_count(),
+        )
+
+    def write(self, **event):
+        event["t"] = round(time.time() - self.started_at, 6)
+        self.out.write(json.dumps(event) + "\n")
+
+    def on_text_changed(self, changes):
+        for change in changes:
+            self.write(
+                event="edit",
+                offset=change.a.pt,
+                removed=change.b.pt - change.a.pt,
+                inserted=change.str,
+            )
+
+    def on_selection(self, view):
+        self.write(event="selection", regions=[[r.a, r.b] for r in view.sel()])
+
+    def close(self):
+        if self.is_attached():
+            self.detach()
+        self.out.close()
+
+
+class SessionSelectionRecorder(sublime_plugin.EventListener):
+    def on_selection_modified(self, view):
+        if SessionRecorder.recorders:
+            recorder = SessionRecorder.recorders.get(view.buffer_id())
+            if recorder is not None:
+                recorder.on_selection(view)
+
+    def on_close(self, view):
+        if SessionRecorder.recorders and not view.buffer().views():
+            recorder = SessionRecorder.recorders.pop(view.buffer_id(), None)
+            if recorder is not None:
+                recorder.close()
+
+
+################################### REPLAYING ##################################
+
+
+def read_session(path):
+    with open(path, encoding="utf8") as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    stats = {
+        "p%s" % p: values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+        for p in PERCENTILES
+    }
+    stats["max"] = values[-1]
+    return stats
+
+
+def replay_session(path, speed=1.0):
+    """
+
+    Replays a recorded session against a HeadlessView, with the original
+    timing (scaled by `speed`), calling the same listener entry points Sublime
+    would. Returns a report dict, see `replay_report`.
+
+    """
+    load_libs()
+    events = read_session(path)
+
+    view = HeadlessView(events[0]["text"])
+    view_data = ViewData.buffer_data[view.buffer_id()][1][KEY]
+    view_data.build_log = build_log = []
+
+    builder, show_xpath, view_data_listener = ProxyBuilder(), ShowXPath(), ViewData()
+    edits, selections = [], []
+
+    began = time.time()
+    builder.trigger(view)
+
+    try:
+        for event in events[1:]:
+            delay = began + event["t"] / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            if event["event"] == "edit":
+                offset = event["offset"]
+                view.replace(offset, offset + event["removed"], event["inserted"])
+                edits.append((time.time(), view.change_count()))
+                track_edits(view, [(offset, event["removed"], event["inserted"])])
+
+                view_data_listener.on_modified(view)
+                builder.on_modified_async(view)
+
+            elif event["event"] == "selection":
+                view.sel().clear()
+                view.sel().add_all(sublime.Region(a, b) for (a, b) in event["regions"])
+                selections.append(time.time())
+
+                show_xpath.on_selection_modified_async(view)
+
+        # Give the last build a chance to land
+        deadline = time.time() + REPLAY_SETTLE_TIMEOUT
+        while time.time() < deadline and not any(
+            outcome == "built" and start_mod == view.change_count()
+            for (outcome, start_mod, started, ended) in build_log
+        ):
+            time.sleep(0.01)
+
+        return replay_report(edits, selections, list(build_log), view.region_log)
+
+    finally:
+        ViewData.buffer_data.pop(view.buffer_id(), None)
+        ViewData.data.pop(view.view_id, None)
+        ViewData.oneoff_callbacks.pop(view.view_id, None)
+
+
+def replay_report(edits, selections, build_log, region_log):
+    """
+
+    time_to_valid_proxy: per edit, seconds until a proxy built from that
+                         buffer state (or a later one) was published
+    wasted:              rebuilds abandoned by `Bailed`, and the seconds spent
+    highlight_latency:   per selection event, seconds until the `xpath`
+                         highlights were next redrawn
+
+    """
+    built = [
+        (start_mod, ended)
+        for (outcome, start_mod, _, ended) in build_log
+        if outcome == "built"
+    ]
+    bailed = [
+        ended - started
+        for (outcome, _, started, ended) in build_log
+        if outcome == "bailed"
+    ]
+
+    time_to_valid, unresolved = [], 0
+    for edited_at, change_count in edits:
+        landed = [ended for (start_mod, ended) in built if start_mod >= change_count]
+        if landed:
+            time_to_valid.append(min(landed) - edited_at)
+        else:
+            unresolved += 1
+
+    redraws = [t for (t, key) in region_log if key == "xpath"]
+    highlight_latency, missed = [], 0
+    for selected_at in selections:
+        after = [t for t in redraws if t >= selected_at]
+        if after:
+            highlight_latency.append(after[0] - selected_at)
+        else:
+            missed += 1
+
+    build_seconds = sum(ended - started for (_, _, started, ended) in build_log)
+
+    return {
+        "edits": len(edits),
+        "selections": len(selections),
+        "time_to_valid_proxy": percentiles(time_to_valid),
+        "unresolved_edits": unresolved,
+        "builds": len(built),
+        "bailed_builds": len(bailed),
+        "wasted_seconds": sum(bailed),
+        "wasted_ratio": sum(bailed) / build_seconds if build_seconds else 0,
+        "highlight_latency": percentiles(highlight_latency),
+        "missed_highlights": missed,
+    }
+
+
+def format_replay_report(path, report):
+    lines = ["Replay of %s" % path]
+
+    for key, value in report.items():
+        if isinstance(value, dict):
+            value = "  ".join("%s=%.1fms" % (k, v * 1000) for k, v in value.items())
+        elif isinstance(value, float):
+            value = "%.3f" % value
+        lines.append("  %-20s %s" % (key, value))
+
+    return "\n".join(lines)
+
+
+################################### COMMANDS ###################################
+
+
+class NodeSelectRecordSession(sublime_plugin.TextCommand):
+    "Starts recording this buffer's edits and selections, or stops if it is"
+
+    def run(self, edit, path=None):
+        buffer_id = self.view.buffer_id()
+
+        recorder = SessionRecorder.recorders.pop(buffer_id, None)
+        if recorder is not None:
+            recorder.close()
+            sublime.status_message("NodeSelect: session saved to %s" % recorder.path)
+            return
+
+        if path is None:
+            folder = os.path.join(sublime.cache_path(), KEY, "sessions")
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, time.strftime("%Y%m%d-%H%M%S.jsonl"))
+
+        recorder = SessionRecorder(self.view, path)
+        recorder.attach(self.view.buffer())
+        SessionRecorder.recorders[buffer_id] = recorder
+        recorder.on_selection(self.view)
+
+        sublime.status_message("NodeSelect: recording session to %s" % path)
+
+    def is_checked(self, **args):
+        return self.view.buffer_id() in SessionRecorder.recorders
+
+
+class NodeSelectReplaySession(sublime_plugin.WindowCommand):
+    def run(self, path=None, speed=1.0):
+        if path is None:
+            self.window.show_input_panel(
+                "Session file: ",
+                os.path.join(sublime.cache_path(), KEY, "sessions", ""),
+                lambda p: self.run(p, speed),
+                None,
+                None,
+            )
+            return
+
+        def show(report):
+            panel = self.window.create_output_panel("node_select_replay")
+            panel.run_command("append", {"characters": report + "\n"})
+            self.window.run_command(
+                "show_panel", {"panel": "output.node_select_replay"}
+            )
+
+        def replay():
+            report = format_replay_report(path, replay_session(path, speed))
+            sublime.set_timeout(lambda: show(report))
+
+        # Not on the async worker, which replays sleep through for the whole
+        # session, starving the `*_async` listeners being measured
+        threading.Thread(target=replay, daemon=True).start()
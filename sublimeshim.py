@@ -0,0 +1,181 @@
+# coding: utf8
+#################################### IMPORTS ###################################
+
+# Std Libs
+import sys
+import tempfile
+import threading
+import types
+
+################################### CONSTANTS ##################################
+
+DRAW_NO_FILL = 32
+DRAW_NO_OUTLINE = 256
+DRAW_STIPPLED_UNDERLINE = 512
+
+LITERAL = 1
+IGNORECASE = 2
+
+#################################### REGION ####################################
+
+
+class Region:
+    "Just the parts of `sublime.Region` NodeSelect uses"
+
+    def __init__(self, a, b=None):
+        if b is None:
+            b = a
+        self.a = a
+        self.b = b
+
+    def __repr__(self):
+        return "(%d, %d)" % (self.a, self.b)
+
+    def __len__(self):
+        return self.size()
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and (self.a, self.b) == (other.a, other.b)
+
+    def __hash__(self):
+        return hash((self.a, self.b))
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return abs(self.b - self.a)
+
+    def empty(self):
+        return self.a == self.b
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+    def to_tuple(self):
+        return (self.a, self.b)
+
+
+################################### FUNCTIONS ##################################
+
+
+def set_timeout(f, delay=0):
+    timer = threading.Timer(delay / 1000, f)
+    timer.daemon = True
+    timer.start()
+
+
+set_timeout_async = set_timeout
+
+
+def status_message(msg):
+    sys.stderr.write("%s\n" % msg)
+
+
+def cache_path():
+    return tempfile.gettempdir()
+
+
+################################ PLUGIN CLASSES ################################
+
+
+class EventListener:
+    pass
+
+
+class ViewEventListener:
+    def __init__(self, view):
+        self.view = view
+
+
+class TextCommand:
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand:
+    def __init__(self, window):
+        self.window = window
+
+
+class ApplicationCommand:
+    pass
+
+
+class TextChangeListener:
+    def __init__(self):
+        self.buffer = None
+
+    def attach(self, buffer):
+        self.buffer = buffer
+
+    def detach(self):
+        self.buffer = None
+
+    def is_attached(self):
+        return self.buffer is not None
+
+
+################################## INSTALLING ##################################
+
+
+def install_sublime_shim():
+    """
+
+    Registers this module's stand-ins as `sublime` and `sublime_plugin`, so
+    the plugin modules import outside of Sublime Text, ie from build scripts.
+    Does nothing if the real modules are importable. Returns True if the shim
+    was installed.
+
+    """
+    try:
+        import sublime  # noqa: F401
+        import sublime_plugin  # noqa: F401
+
+        return False
+    except ImportError:
+        pass
+
+    namespace = globals()
+
+    stand_ins = (
+        (
+            "sublime",
+            (
+                "Region",
+                "DRAW_NO_FILL",
+                "DRAW_NO_OUTLINE",
+                "DRAW_STIPPLED_UNDERLINE",
+                "LITERAL",
+                "IGNORECASE",
+                "set_timeout",
+                "set_timeout_async",
+                "status_message",
+                "cache_path",
+            ),
+        ),
+        (
+            "sublime_plugin",
+            (
+                "EventListener",
+                "ViewEventListener",
+                "TextCommand",
+                "WindowCommand",
+                "ApplicationCommand",
+                "TextChangeListener",
+            ),
+        ),
+    )
+
+    for name, attrs in stand_ins:
+        module = types.ModuleType(name)
+        for attr in attrs:
+            setattr(module, attr, namespace[attr])
+        sys.modules[name] = module
+
+    return True